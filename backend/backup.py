@@ -0,0 +1,94 @@
+"""会话的流式导出与导入工具，格式与 GET /export、POST /import 相同
+
+在backend目录下运行：
+    python backup.py export backup.ndjson.gz [--user 用户名] [--no-files]
+    python backup.py import backup.ndjson.gz [--user 用户名] [--keep-owners]
+
+路径以.gz结尾时导出为gzip压缩，导入时自动识别是否压缩；路径为 - 时使用标准输出/输入。
+导出默认包含所有用户的会话，可以在服务运行时进行。导入直接写入数据库，
+服务运行时导入的会话在重启后才会出现在会话列表中。
+"""
+import sys
+import time
+import argparse
+from modules.database import init_db
+from modules.archive import init_archive_db
+from modules.documents import init_documents_db
+from modules.transfer import iter_export, Importer
+from modules import auth
+
+READ_CHUNK_BYTES = 1024 * 1024
+
+def resolve_user_id(username: str) -> str:
+    user = auth.get_user_by_username(username)
+    if user is None:
+        sys.exit(f"用户不存在: {username}")
+    return user.id
+
+def export_command(args):
+    owner_id = resolve_user_id(args.user) if args.user else None
+    compress = args.path.endswith(".gz")
+    output = sys.stdout.buffer if args.path == "-" else open(args.path, "wb")
+
+    start = time.perf_counter()
+    size = 0
+    try:
+        for chunk in iter_export(owner_id, not args.no_files, compress):
+            output.write(chunk)
+            size += len(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    print(f"已导出 {size / 1024 / 1024:.1f} MB，耗时 {time.perf_counter() - start:.1f} 秒", file=sys.stderr)
+
+def import_command(args):
+    owner_id = resolve_user_id(args.user) if args.user else auth.admin_user_id
+    source = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+
+    start = time.perf_counter()
+    importer = Importer(owner_id, keep_owners=args.keep_owners)
+    try:
+        while True:
+            chunk = source.read(READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            importer.feed(chunk)
+        importer.finish()
+    except ValueError as e:
+        sys.exit(f"导入失败: {e}（已导入{importer.stats['sessions']}个会话）")
+    finally:
+        importer.close()
+        if source is not sys.stdin.buffer:
+            source.close()
+
+    stats = importer.stats
+    print(f"已导入 {stats['sessions']} 个会话、{stats['messages']} 条消息、{stats['files']} 个文件，"
+          f"耗时 {time.perf_counter() - start:.1f} 秒", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="以NDJSON流式导出或导入会话")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="导出会话")
+    export_parser.add_argument("path", help="输出文件，以.gz结尾时压缩，- 表示标准输出")
+    export_parser.add_argument("--user", help="只导出该用户的会话，默认导出所有用户")
+    export_parser.add_argument("--no-files", action="store_true", help="不包含引用的上传文件")
+    export_parser.set_defaults(handler=export_command)
+
+    import_parser = subparsers.add_parser("import", help="导入会话")
+    import_parser.add_argument("path", help="导出文件，- 表示标准输入")
+    import_parser.add_argument("--user", help="会话归属的用户，默认为管理员")
+    import_parser.add_argument("--keep-owners", action="store_true",
+                               help="按导出文件中的用户名归属到已存在的用户")
+    import_parser.set_defaults(handler=import_command)
+
+    args = parser.parse_args()
+
+    init_db()
+    init_archive_db()
+    auth.init_auth_db()
+    init_documents_db()
+    args.handler(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""记忆检索基准测试：在100万个向量上测量按用户过滤的暴力检索延迟
+
+一个用户拥有90%的向量（最坏情况：检索需要对约90万行计算相似度），
+其余向量均匀分给另外999个用户，两类用户的检索延迟分别统计。
+
+在backend目录下运行：python benchmarks/bench_memory.py [向量数] [维度]
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from modules.memory import VectorIndex, LocalEmbedder, normalize
+
+VECTOR_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+DIMENSIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+OWNER_COUNT = 1000
+# 第一个用户拥有的向量比例
+HEAVY_SHARE = 0.9
+QUERIES = 50
+BATCH = 100_000
+
+def main():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = VectorIndex(os.path.join(tmp, "bench"), DIMENSIONS, "bench")
+        index.reset()
+        index.reserve(VECTOR_COUNT)
+        owners = [f"user-{i}" for i in range(OWNER_COUNT)]
+
+        start = time.perf_counter()
+        for offset in range(0, VECTOR_COUNT, BATCH):
+            count = min(BATCH, VECTOR_COUNT - offset)
+            vectors = normalize(rng.standard_normal((count, DIMENSIONS), dtype=np.float32))
+            heavy = rng.random(count) < HEAVY_SHARE
+            owner_ids = [owners[0] if h else owners[i] for h, i in zip(heavy, rng.integers(1, OWNER_COUNT, count))]
+            rows = range(offset, offset + count)
+            index.add([f"session-{row // 1000}" for row in rows], [row % 1000 for row in rows],
+                      owner_ids, list(rows), vectors)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reloaded = VectorIndex(os.path.join(tmp, "bench"), DIMENSIONS, "bench")
+        reloaded.load()
+        load_time = time.perf_counter() - start
+
+        def measure(owner_ids):
+            latencies = []
+            for i in range(QUERIES):
+                query = normalize(rng.standard_normal((1, DIMENSIONS), dtype=np.float32))[0]
+                start = time.perf_counter()
+                reloaded.search(owner_ids[i % len(owner_ids)], query, 12)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+
+        heavy_count = int(np.count_nonzero(reloaded.owner_codes[:reloaded.size] == reloaded.owner_lookup[owners[0]]))
+        heavy_p50, heavy_p95 = measure(owners[:1])
+        light_p50, light_p95 = measure(owners[1:])
+
+        embedder = LocalEmbedder(DIMENSIONS)
+        text = "这是一条用于测试本地嵌入速度的聊天消息，包含一些常见的中文内容。" * 4
+        start = time.perf_counter()
+        for _ in range(100):
+            embedder.embed([text])
+        embed_time = (time.perf_counter() - start) * 10
+
+        print(f"向量数: {reloaded.size}  维度: {DIMENSIONS}  用户数: {OWNER_COUNT}")
+        print(f"索引内存: {reloaded.vectors.nbytes / 1024 / 1024:.1f} MB")
+        print(f"追加写入耗时: {build_time:.2f} s  加载耗时: {load_time:.2f} s")
+        print(f"最大用户（{heavy_count} 个向量）检索延迟 p50: {heavy_p50:.2f} ms  p95: {heavy_p95:.2f} ms")
+        light_count = (reloaded.size - heavy_count) // (OWNER_COUNT - 1)
+        print(f"其他用户（平均 {light_count} 个向量）检索延迟 p50: {light_p50:.2f} ms  p95: {light_p95:.2f} ms")
+        print(f"本地嵌入单条耗时: {embed_time:.3f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""提示词前缀基准测试：逐轮构建包含图片和文档的会话提示词，
+校验每一轮的历史前缀与上一轮逐字节一致，并对比复用前缀与全量渲染的耗时
+
+在backend目录下运行：python benchmarks/bench_prompt_cache.py [轮数]
+"""
+import os
+import sys
+import time
+import hashlib
+import tempfile
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from modules.models import ChatSession, Message
+from modules.database import init_db
+from modules.documents import init_documents_db, register_upload, extract_document, extract_queue
+from modules.serialization import dumps
+from modules import prompt_builder
+
+TURNS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+def write_file(path: str, data: bytes) -> str:
+    """写入测试文件并返回其内容哈希"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+def prepare_files():
+    """准备一张图片和一份已提取的文档，以及一份仍在提取中的文档"""
+    write_file("uploads/photo.png", b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 16)
+
+    text = "".join(f"第{i}行：用于测试文档上下文的内容。\n" for i in range(2000)).encode("utf-8")
+    content_hash = write_file("uploads/report.txt", text)
+    register_upload("/uploads/report.txt", content_hash, "report.txt", len(text), "uploads/report.txt")
+
+    pending = b"pending document\n" * 10
+    write_file("uploads/pending.txt", pending)
+    register_upload("/uploads/pending.txt", hashlib.sha256(pending).hexdigest(), "pending.txt", len(pending), "uploads/pending.txt")
+
+    # 同步提取第一份文档，第二份保持提取中
+    content_hash, file_path, original_name = extract_queue.get()
+    extract_document(content_hash, file_path, original_name)
+    extract_queue.get()
+    return hashlib.sha256(pending).hexdigest()
+
+def build_message(turn: int, role: str) -> Message:
+    """构造第turn轮的消息，部分消息带有附件"""
+    file_urls = None
+    if role == "user" and turn == 0:
+        file_urls = ["/uploads/photo.png", "/uploads/report.txt"]
+    elif role == "user" and turn == 3:
+        file_urls = ["/uploads/pending.txt"]
+    return Message(
+        role=role,
+        content=f"第{turn}轮{role}消息：" + "这是一段用于基准测试的聊天内容。" * 4,
+        timestamp=datetime.now().isoformat(),
+        file_urls=file_urls
+    )
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        init_db()
+        init_documents_db()
+        pending_hash = prepare_files()
+
+        now = datetime.now().isoformat()
+        session = ChatSession(id="bench", title="基准测试", created_at=now, updated_at=now, messages=[])
+
+        previous = []
+        cached_time = 0.0
+        cold_time = 0.0
+        for turn in range(TURNS):
+            if turn == 6:
+                # 第二份文档提取完成，之后的轮次应重新渲染该消息及其之后的消息
+                extract_document(pending_hash, "uploads/pending.txt", "pending.txt")
+                previous = previous[:6]
+
+            session.messages.append(build_message(turn, "user"))
+
+            start = time.perf_counter()
+            messages = prompt_builder.build_prompt_messages(session)
+            cached_time += time.perf_counter() - start
+
+            # 不使用缓存重新渲染，结果必须与复用前缀的结果完全相同
+            prompt_builder.forget_session_prompt(session.id)
+            start = time.perf_counter()
+            cold = prompt_builder.build_prompt_messages(session)
+            cold_time += time.perf_counter() - start
+            assert dumps(cold) == dumps(messages), f"第{turn}轮复用前缀与全量渲染结果不一致"
+
+            # 上一轮发送的全部消息必须逐字节保持不变
+            for index, rendered in enumerate(previous):
+                assert dumps(messages[index]) == rendered, f"第{turn}轮第{index}条消息的前缀发生变化"
+            previous = [dumps(message) for message in messages]
+
+            session.messages.append(build_message(turn, "assistant"))
+
+        prompt_bytes = len(dumps(messages))
+        print(f"轮数: {TURNS}，最终提示词 {len(messages)} 条消息，{prompt_bytes / 1024:.1f} KB")
+        print(f"每轮构建（复用前缀）: {cached_time / TURNS * 1000:.3f} ms")
+        print(f"每轮构建（全量渲染）: {cold_time / TURNS * 1000:.3f} ms")
+        print("所有轮次的历史前缀逐字节一致")
+        os.chdir(BACKEND_DIR)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""序列化基准测试：对比10k条消息会话在默认路径与快速路径下的耗时和字节数
+
+在backend目录下运行：python benchmarks/bench_serialization.py
+"""
+import os
+import sys
+import time
+import gzip
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from modules.models import ChatSession, Message
+from modules.serialization import FastJSONResponse, session_to_dict, compress, brotli, orjson
+
+MESSAGE_COUNT = 10000
+ROUNDS = 5
+
+def build_rows():
+    """构造模拟的数据库行"""
+    now = datetime.now().isoformat()
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"第{i}条消息：" + "这是一段用于基准测试的聊天内容。" * 8,
+            "timestamp": now,
+            "file_urls": ["/uploads/example.png"] if i % 50 == 0 else None
+        }
+        for i in range(MESSAGE_COUNT)
+    ]
+
+def build_session(rows, per_message: bool) -> ChatSession:
+    """从行数据构建会话，per_message决定是否逐条构造Message对象"""
+    now = datetime.now().isoformat()
+    if per_message:
+        return ChatSession(
+            id="bench", title="基准测试", created_at=now, updated_at=now,
+            messages=[Message(**row) for row in rows]
+        )
+    return ChatSession.model_validate({
+        "id": "bench", "title": "基准测试", "created_at": now, "updated_at": now,
+        "messages": rows
+    })
+
+def timed(func):
+    """返回函数多轮执行的最短耗时（毫秒）和最后一次结果"""
+    best = float("inf")
+    result = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+def main():
+    rows = build_rows()
+
+    load_before, session = timed(lambda: build_session(rows, per_message=True))
+    load_after, _ = timed(lambda: build_session(rows, per_message=False))
+
+    dump_before, body_before = timed(lambda: JSONResponse(jsonable_encoder(session)).body)
+    dump_after, body_after = timed(lambda: FastJSONResponse(session_to_dict(session)).body)
+
+    gzip_time, gzip_body = timed(lambda: compress(body_after, "gzip"))
+
+    print(f"消息数: {MESSAGE_COUNT}  orjson: {'是' if orjson else '否'}  brotli: {'是' if brotli else '否'}")
+    print(f"{'阶段':<24}{'耗时(ms)':>12}{'字节':>14}")
+    print(f"{'加载 Message(...)':<24}{load_before:>12.2f}{'-':>14}")
+    print(f"{'加载 行字典批量校验':<24}{load_after:>12.2f}{'-':>14}")
+    print(f"{'序列化 默认':<24}{dump_before:>12.2f}{len(body_before):>14}")
+    print(f"{'序列化 快速':<24}{dump_after:>12.2f}{len(body_after):>14}")
+    print(f"{'gzip 压缩':<24}{gzip_time:>12.2f}{len(gzip_body):>14}")
+    if brotli is not None:
+        br_time, br_body = timed(lambda: compress(body_after, "br"))
+        print(f"{'brotli 压缩':<24}{br_time:>12.2f}{len(br_body):>14}")
+
+if __name__ == "__main__":
+    main()
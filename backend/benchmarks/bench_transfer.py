@@ -0,0 +1,233 @@
+"""导出导入测试：生成大量会话和消息（部分已归档、部分引用上传文件），
+流式导出为gzip压缩的NDJSON再导入给另一个用户，测量耗时和Python内存峰值，
+并验证导入后的消息与原数据一致、中途中断的导入不留下不完整的会话、
+字段类型不对的记录被拒绝
+
+在backend目录下运行：python benchmarks/bench_transfer.py [会话数] [每个会话的消息数]
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+SESSIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+MESSAGES_PER_SESSION = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+ARCHIVED_EVERY = 10  # 每10个会话归档1个
+FILES = 20
+FILE_SIZE = 512 * 1024
+
+def populate(conn, owner_id):
+    """直接写入数据库，生成测试数据"""
+    from modules.database import UPLOAD_DIR
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    file_urls = []
+    for i in range(FILES):
+        with open(os.path.join(UPLOAD_DIR, f"file-{i}.txt"), "wb") as f:
+            f.write(os.urandom(FILE_SIZE // 2).hex().encode("ascii"))
+        file_urls.append(f"/{UPLOAD_DIR}/file-{i}.txt")
+
+    rng = random.Random(0)
+    for s in range(SESSIONS):
+        session_id = f"s{s:08d}"
+        conn.execute(
+            "INSERT INTO sessions (id, title, created_at, updated_at, model, api_provider, owner_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (session_id, f"会话 {s}", "2024-01-01T00:00:00", "2024-01-02T00:00:00", "gpt-4o", "OpenAI", owner_id)
+        )
+        rows = []
+        for m in range(MESSAGES_PER_SESSION):
+            urls = [file_urls[rng.randrange(FILES)]] if m % 100 == 0 else None
+            rows.append((
+                session_id,
+                "user" if m % 2 == 0 else "assistant",
+                f"消息 {s}-{m} " + "内容" * rng.randrange(10, 60),
+                json.dumps(urls) if urls else None,
+                f"2024-01-01T00:{m // 60 % 60:02d}:{m % 60:02d}"
+            ))
+        conn.executemany(
+            "INSERT INTO messages (session_id, role, content, file_urls, timestamp) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.commit()
+
+def load_session(session_id):
+    from modules.transfer import open_connection, iter_session_messages
+    conn = open_connection()
+    try:
+        return list(iter_session_messages(conn, session_id))
+    finally:
+        conn.close()
+
+def run():
+    from modules.database import init_db, get_db_connection, UPLOAD_DIR
+    from modules.archive import init_archive_db, archive_session_in_db
+    from modules.documents import init_documents_db
+    from modules.transfer import iter_export, Importer
+    from modules import auth
+
+    init_db()
+    init_archive_db()
+    auth.init_auth_db()
+    init_documents_db()
+    source = auth.create_user("source", "bench")
+    target = auth.create_user("target", "bench")
+    partial = auth.create_user("partial", "bench")
+
+    conn = get_db_connection()
+    start = time.perf_counter()
+    populate(conn, source.id)
+    conn.close()
+    for s in range(0, SESSIONS, ARCHIVED_EVERY):
+        archive_session_in_db(f"s{s:08d}")
+    total = SESSIONS * MESSAGES_PER_SESSION
+    print(f"生成 {SESSIONS} 个会话、{total} 条消息，耗时 {time.perf_counter() - start:.1f} 秒，"
+          f"数据库 {os.path.getsize('sessions.db') / 1024 / 1024:.0f} MB")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = 0
+    with open("export.ndjson.gz", "wb") as f:
+        for chunk in iter_export(source.id, include_files=True, compress=True):
+            f.write(chunk)
+            size += len(chunk)
+    export_time = time.perf_counter() - start
+    export_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"导出: {size / 1024 / 1024:.1f} MB，耗时 {export_time:.1f} 秒（{total / export_time:.0f} 条/秒），"
+          f"内存峰值 {export_peak / 1024 / 1024:.1f} MB")
+
+    # 导入到同一个服务器：内容相同的文件直接复用；修改其中一个，导入时应另存为新文件
+    changed_url = f"/{UPLOAD_DIR}/file-0.txt"
+    with open(changed_url.lstrip('/'), "rb") as f:
+        changed_content = f.read()
+    with open(changed_url.lstrip('/'), "wb") as f:
+        f.write(b"changed")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    importer = Importer(target.id)
+    committed = 0
+    with open("export.ndjson.gz", "rb") as f:
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            importer.feed(chunk)
+            committed += len(importer.take_committed())
+    importer.finish()
+    committed += len(importer.take_committed())
+    importer.close()
+    import_time = time.perf_counter() - start
+    import_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"导入: {importer.stats}，耗时 {import_time:.1f} 秒（{total / import_time:.0f} 条/秒），"
+          f"内存峰值 {import_peak / 1024 / 1024:.1f} MB")
+
+    assert importer.stats == {"sessions": SESSIONS, "messages": total, "files": 1}, importer.stats
+    assert committed == SESSIONS
+
+    # 按顺序对比若干会话的消息，被修改的文件URL应已替换为保存原内容的新文件
+    conn = get_db_connection()
+    imported = [row['id'] for row in conn.execute(
+        "SELECT id FROM sessions WHERE owner_id = ? ORDER BY id", (target.id,)
+    )]
+    # 导入的消息写入消息表而不是归档表
+    assert conn.execute(
+        "SELECT COUNT(*) FROM messages m JOIN sessions s ON s.id = m.session_id WHERE s.owner_id = ?", (target.id,)
+    ).fetchone()[0] == total
+    conn.close()
+    for s in (0, 1, SESSIONS // 2, SESSIONS - 1):
+        original, copy = load_session(f"s{s:08d}"), load_session(imported[s])
+        assert len(original) == len(copy) == MESSAGES_PER_SESSION
+        for a, b in zip(original, copy):
+            assert (a['role'], a['content'], a['timestamp']) == (b['role'], b['content'], b['timestamp'])
+            if a['file_urls'] == [changed_url]:
+                assert b['file_urls'] != a['file_urls']
+                with open(b['file_urls'][0].lstrip('/'), "rb") as f:
+                    assert f.read() == changed_content
+            else:
+                assert a['file_urls'] == b['file_urls']
+    print("导入后的消息和文件与原数据一致")
+
+    # 缺少最后一部分数据时中断，已提交的会话应完整，写了一半的会话应被删除
+    with gzip.open("export.ndjson.gz", "rb") as f:
+        lines = f.readlines()
+    importer = Importer(partial.id)
+    importer.feed(b"".join(lines[:len(lines) * 9 // 10]))
+    importer.close()
+    conn = get_db_connection()
+    counts = [row[0] for row in conn.execute('''
+        SELECT COUNT(m.id) FROM sessions s LEFT JOIN messages m ON m.session_id = s.id
+        WHERE s.owner_id = ? GROUP BY s.id
+    ''', (partial.id,))]
+    conn.close()
+    assert all(count == MESSAGES_PER_SESSION for count in counts), counts
+    assert importer.stats["sessions"] == len(counts) and importer.stats["messages"] == sum(counts), importer.stats
+    print(f"中断的导入保留了 {len(counts)} 个完整的会话")
+
+    check_malformed(partial.id)
+
+def check_malformed(owner_id):
+    """字段类型不对的记录应以ValueError拒绝（接口返回400），不留下无法打开的会话"""
+    from modules.database import get_db_connection
+    from modules.transfer import Importer
+
+    malformed = [
+        {"type": "message", "role": "user", "content": "x", "file_urls": [5]},
+        {"type": "message", "role": "user", "content": "x", "file_urls": 5},
+        {"type": "message", "role": "user", "content": "x", "file_urls": "/uploads/a.txt"},
+        {"type": "message", "role": "user", "content": "x", "timestamp": 5},
+        {"type": "message", "role": 1, "content": "x"},
+        {"type": "message", "role": "user", "content": None},
+    ]
+    conn = get_db_connection()
+    before = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    for record in malformed:
+        lines = [{"type": "export", "version": 1}, {"type": "session", "id": "bad", "title": "bad"},
+                 {"type": "message", "role": "user", "content": "ok", "timestamp": "t"}, record]
+        importer = Importer(owner_id)
+        try:
+            importer.feed(b"".join(json.dumps(line).encode() + b"\n" for line in lines))
+            importer.finish()
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"未拒绝: {record}")
+        finally:
+            importer.close()
+    for record in [{"type": "session", "id": "bad", "created_at": 5}, {"type": "session", "id": "bad", "owner": {}}]:
+        importer = Importer(owner_id)
+        try:
+            importer.feed(b"".join(json.dumps(line).encode() + b"\n" for line in [{"type": "export", "version": 1}, record]))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"未拒绝: {record}")
+        finally:
+            importer.close()
+    assert conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == before
+    conn.close()
+    print(f"拒绝了 {len(malformed) + 2} 种字段类型不对的记录")
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open("config.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "providers": [],
+                "auth": {"enabled": True, "username": "bench", "password": "bench"},
+                "archive": {"enabled": False}
+            }, f)
+        try:
+            run()
+        finally:
+            os.chdir(BACKEND_DIR)
+
+if __name__ == "__main__":
+    main()
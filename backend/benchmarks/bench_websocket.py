@@ -0,0 +1,209 @@
+"""WebSocket负载测试：在同一进程内直接驱动ASGI应用，建立数千个空闲连接和若干活跃连接，
+使用模拟的流式提供商，测量每个空闲连接的内存、首个token延迟和整轮延迟，
+并验证慢客户端的发送队列不超过上限、合并后的内容完整
+
+在backend目录下运行：python benchmarks/bench_websocket.py [空闲连接数] [活跃连接数]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import tracemalloc
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+IDLE_CONNECTIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+ACTIVE_CONNECTIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+SLOW_CONNECTIONS = 20
+CONNECTIONS_PER_USER = 10  # 活跃用户同时打开的连接数，用户的每轮聊天会通知其他连接
+TURNS_PER_CONNECTION = 5
+TOKENS_PER_TURN = 50
+TOKEN_INTERVAL = 0.002  # 模拟提供商每个token的间隔（秒）
+SLOW_SEND_DELAY = 0.05  # 慢客户端每接收一帧的耗时（秒）
+SEND_QUEUE_SIZE = 16
+
+async def mock_stream(messages, model, provider=None):
+    """模拟流式提供商，固定输出TOKENS_PER_TURN个token"""
+    for i in range(TOKENS_PER_TURN):
+        await asyncio.sleep(TOKEN_INTERVAL)
+        yield f"tok{i} ", None
+    yield "", {"prompt_tokens": 100, "completion_tokens": TOKENS_PER_TURN}
+
+EXPECTED_TEXT = "".join(f"tok{i} " for i in range(TOKENS_PER_TURN))
+
+class Client:
+    """进程内的WebSocket客户端，通过ASGI的receive/send与应用交互"""
+
+    def __init__(self, app, slow: bool = False):
+        self.app = app
+        self.slow = slow
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.frames: asyncio.Queue = asyncio.Queue()
+        self.task = None
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    async def send(self, message):
+        if self.slow and message["type"] == "websocket.send":
+            await asyncio.sleep(SLOW_SEND_DELAY)
+        self.frames.put_nowait(message)
+
+    async def connect(self, token: str):
+        scope = {
+            "type": "websocket", "path": "/ws", "raw_path": b"/ws", "root_path": "",
+            "scheme": "ws", "query_string": b"", "headers": [],
+            "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 8000), "subprotocols": [],
+            "asgi": {"version": "3.0"}
+        }
+        self.task = asyncio.create_task(self.app(scope, self.receive, self.send))
+        self.inbox.put_nowait({"type": "websocket.connect"})
+        accepted = await self.frames.get()
+        assert accepted["type"] == "websocket.accept", accepted
+        self.send_json({"type": "auth", "token": token})
+        ready = await self.receive_json()
+        assert ready["type"] == "ready", ready
+
+    def send_json(self, frame: dict):
+        self.inbox.put_nowait({"type": "websocket.receive", "text": json.dumps(frame)})
+
+    async def receive_json(self) -> dict:
+        message = await self.frames.get()
+        assert message["type"] == "websocket.send", message
+        return json.loads(message["text"])
+
+    async def chat(self, request_id: str, session_id: str) -> tuple:
+        """发送一轮聊天，返回(首个token延迟, 整轮延迟, token帧数, 拼接后的内容)"""
+        start = time.perf_counter()
+        self.send_json({"type": "chat", "request_id": request_id, "session_id": session_id, "message": "hello"})
+        first = None
+        frames = 0
+        parts = []
+        while True:
+            frame = await self.receive_json()
+            if frame["type"] == "token":
+                first = first or time.perf_counter() - start
+                frames += 1
+                parts.append(frame["delta"])
+            elif frame["type"] == "done":
+                return first, time.perf_counter() - start, frames, "".join(parts)
+            elif frame["type"] != "session":
+                raise AssertionError(frame)
+
+    async def close(self):
+        self.inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        await self.task
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] * 1000
+
+async def run():
+    from main import app
+    from modules import realtime, auth, chat
+    from modules.startup import warm_up
+    from modules.session_manager import create_session
+
+    chat.stream_openai_api = mock_stream
+    await warm_up()
+
+    def login_as(username: str) -> tuple:
+        user = auth.create_user(username, "bench", daily_message_quota=0, session_quota=0)
+        return user.id, auth.login(username, "bench")
+
+    # 空闲连接：只完成认证，测量每个连接的内存开销
+    _, idle_token = login_as("idle")
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    idle = []
+    start = time.perf_counter()
+    for _ in range(IDLE_CONNECTIONS):
+        client = Client(app)
+        await client.connect(idle_token)
+        idle.append(client)
+    connect_time = time.perf_counter() - start
+    per_connection = (tracemalloc.get_traced_memory()[0] - before) / IDLE_CONNECTIONS
+    tracemalloc.stop()
+
+    # 每个活跃用户打开多个连接，会互相收到会话变更通知；慢连接各自使用独立用户，只接收自己的输出
+    active = []
+    for i in range(ACTIVE_CONNECTIONS):
+        if i % CONNECTIONS_PER_USER == 0:
+            active_id, active_token = login_as(f"active-{i}")
+        client = Client(app)
+        await client.connect(active_token)
+        active.append((client, create_session("bench", owner_id=active_id).id))
+    slow = []
+    for i in range(SLOW_CONNECTIONS):
+        slow_id, slow_token = login_as(f"slow-{i}")
+        client = Client(app, slow=True)
+        await client.connect(slow_token)
+        slow.append((client, create_session("bench", owner_id=slow_id).id))
+
+    # 采样慢连接的发送队列长度
+    max_queue = 0
+    sampling = True
+    async def sample_queues():
+        nonlocal max_queue
+        while sampling:
+            for user_connections in list(realtime.connections.values()):
+                for connection in user_connections:
+                    max_queue = max(max_queue, connection.queue.qsize())
+            await asyncio.sleep(0.01)
+    sampler = asyncio.create_task(sample_queues())
+
+    async def converse(client, session_id, index):
+        results = []
+        for turn in range(TURNS_PER_CONNECTION):
+            results.append(await client.chat(f"{index}-{turn}", session_id))
+        return results
+
+    start = time.perf_counter()
+    active_results, slow_results = await asyncio.gather(
+        asyncio.gather(*(converse(client, session_id, i) for i, (client, session_id) in enumerate(active))),
+        asyncio.gather(*(converse(client, session_id, i) for i, (client, session_id) in enumerate(slow)))
+    )
+    total_time = time.perf_counter() - start
+    sampling = False
+    await sampler
+
+    turns = [result for results in active_results for result in results]
+    slow_turns = [result for results in slow_results for result in results]
+    assert all(text == EXPECTED_TEXT for _, _, _, text in turns + slow_turns), "流式内容不完整"
+    assert max_queue <= SEND_QUEUE_SIZE, f"发送队列超过上限: {max_queue}"
+
+    print(f"空闲连接: {IDLE_CONNECTIONS}，建立耗时 {connect_time:.2f} 秒，每个连接约 {per_connection / 1024:.1f} KB")
+    print(f"活跃连接: {ACTIVE_CONNECTIONS}，共 {len(turns)} 轮，总耗时 {total_time:.2f} 秒")
+    print(f"首个token延迟 p50/p95: {percentile([t[0] for t in turns], 0.5):.1f} / {percentile([t[0] for t in turns], 0.95):.1f} ms")
+    print(f"整轮延迟 p50/p95: {percentile([t[1] for t in turns], 0.5):.1f} / {percentile([t[1] for t in turns], 0.95):.1f} ms"
+          f"（模拟提供商生成耗时约 {TOKENS_PER_TURN * TOKEN_INTERVAL * 1000:.0f} ms）")
+    print(f"慢连接: {SLOW_CONNECTIONS}，每轮平均 {sum(t[2] for t in slow_turns) / len(slow_turns):.1f} 个token帧"
+          f"（正常连接 {sum(t[2] for t in turns) / len(turns):.1f} 个），发送队列峰值 {max_queue}/{SEND_QUEUE_SIZE}")
+
+    for client in idle + [client for client, _ in active + slow]:
+        await client.close()
+    assert not realtime.connections, "断开后仍有连接未注销"
+    print("所有连接已正常关闭")
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open("config.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "providers": [],
+                "auth": {"enabled": True, "username": "bench", "password": "bench"},
+                "archive": {"enabled": False},
+                # 不限制并发生成，只测量传输本身
+                "server": {"max_concurrent_generations": ACTIVE_CONNECTIONS + SLOW_CONNECTIONS},
+                "websocket": {"send_queue_size": SEND_QUEUE_SIZE}
+            }, f)
+        try:
+            asyncio.run(run())
+        finally:
+            os.chdir(BACKEND_DIR)
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,16 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from modules.startup import mark_imported, warm_up, ReadinessMiddleware
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from modules.config import openai_clients, auth_enabled, auth_username, auth_password
-from modules.session_manager import initialize_default_session
+from modules.config import archive_enabled, watch_config
 from modules.api_routes import setup_routes
-import secrets
-
-app = FastAPI()
-
-# 创建HTTP Basic认证实例
-security = HTTPBasic()
-
-# 认证依赖函数
-def authenticate(credentials: HTTPBasicCredentials = Depends(security)):
-    # 使用secrets.compare_digest来安全地比较用户名和密码
-    correct_username = secrets.compare_digest(credentials.username, auth_username)
-    correct_password = secrets.compare_digest(credentials.password, auth_password)
-    
-    if not (correct_username and correct_password):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Basic"},
-        )
-    return credentials.username
+from modules.serialization import FastJSONResponse
+from modules.maintenance import maintenance_loop
+import asyncio
+
+app = FastAPI(default_response_class=FastJSONResponse)
+
+# 预热完成前的请求等待就绪，/ready 用于探测启动状态，不等待
+app.add_middleware(ReadinessMiddleware)
 
 # 添加CORS中间件
 app.add_middleware(
@@ -34,20 +21,22 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有头部
 )
 
-# 初始化默认会话
-initialize_default_session()
+async def run_startup():
+    """预热会话数据，完成后启动后台维护任务（归档、上传文件回收、数据库压缩）"""
+    await warm_up()
+    if archive_enabled:
+        asyncio.create_task(maintenance_loop())
+
+# 服务器启动后在后台初始化默认会话，并监听配置文件变化
+@app.on_event("startup")
+async def start_background_tasks():
+    asyncio.create_task(run_startup())
+    asyncio.create_task(watch_config())
 
 # 设置API路由
 setup_routes(app)
 
-# 如果启用了认证，为所有路由添加依赖
-if auth_enabled:
-    # 为所有路由添加认证依赖
-    for route in app.routes:
-        if hasattr(route, "dependencies"):
-            route.dependencies.append(Depends(authenticate))
-        else:
-            route.dependencies = [Depends(authenticate)]
+mark_imported()
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,79 +1,140 @@
-from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile, Request
+from fastapi.security import HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from typing import List, Dict
-from datetime import datetime
 import os
 import uuid
-import base64
-from .models import Message, ChatSession, SessionUpdate, ChatRequest
+import asyncio
+import hashlib
+from datetime import datetime
+from .models import Message, ChatSession, SessionUpdate, ChatRequest, User, LoginRequest, UserCreate
 from .session_manager import (
     get_sessions, create_session, get_session, update_session, 
     delete_session, add_message_to_session, clear_session_messages,
-    initialize_default_session
+    initialize_default_session, count_sessions, search_sessions, add_imported_sessions
+)
+from .chat import prepare_chat_turn, generate_reply, cancel_session_generations, Generation
+from .realtime import websocket_endpoint, notify_session_change
+from .database import UPLOAD_DIR
+from .startup import ready_event, startup_metrics
+from .serialization import FastJSONResponse, session_to_dict, sessions_to_list, message_to_dict
+from .config import get_registry
+from .documents import register_upload
+from .prompt_builder import is_image_file, record_usage, cache_stats
+from .transfer import iter_export, Importer
+from .auth import (
+    security, get_current_user, require_admin, login, logout,
+    create_user
 )
-from .openai_client import call_openai_api
-from .config import openai_clients, default_provider, default_model, providers, auth_enabled, auth_username, auth_password
-import secrets
-
-# 创建HTTP Basic认证实例
-security = HTTPBasic()
-
-# 认证依赖函数
-def authenticate(credentials: HTTPBasicCredentials = Depends(security)):
-    # 使用secrets.compare_digest来安全地比较用户名和密码
-    correct_username = secrets.compare_digest(credentials.username, auth_username)
-    correct_password = secrets.compare_digest(credentials.password, auth_password)
-    
-    if not (correct_username and correct_password):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Basic"},
-        )
-    return credentials.username
-
-def encode_image_to_base64(image_path: str) -> str:
-    """将图片文件编码为base64字符串"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-def is_image_file(file_path: str) -> bool:
-    """检查文件是否为图片"""
-    image_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.webp']
-    _, ext = os.path.splitext(file_path)
-    return ext.lower() in image_extensions
 
 def setup_routes(app: FastAPI):
     """设置API路由"""
     
-    # 确定是否需要认证依赖
-    auth_dependency = Depends(authenticate) if auth_enabled else None
+    # 聊天、流式输出、取消和会话变更通知共用的WebSocket连接
+    app.add_api_websocket_route("/ws", websocket_endpoint)
     
-    @app.get("/", dependencies=[auth_dependency] if auth_enabled else [])
-    async def root():
+    @app.get("/")
+    async def root(user: User = Depends(get_current_user)):
         return {"message": "EasyChatbox API"}
 
-    @app.get("/sessions", dependencies=[auth_dependency] if auth_enabled else [])
-    async def get_sessions_endpoint():
-        """获取所有聊天会话"""
-        return get_sessions()
+    @app.post("/auth/login")
+    async def login_endpoint(request: LoginRequest):
+        """校验用户名和密码并签发令牌（无需认证）"""
+        # 密码哈希计算耗时较长，放到线程中执行，失败的登录请求再多也不会阻塞事件循环
+        token = await asyncio.to_thread(login, request.username, request.password)
+        if token is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect username or password"
+            )
+        return {"token": token, "token_type": "bearer"}
+
+    @app.post("/auth/logout")
+    async def logout_endpoint(credentials: HTTPAuthorizationCredentials = Depends(security)):
+        """吊销当前令牌"""
+        if credentials:
+            logout(credentials.credentials)
+        return {"message": "已退出登录"}
+
+    @app.get("/auth/me")
+    async def me_endpoint(user: User = Depends(get_current_user)):
+        """获取当前用户信息"""
+        return user
+
+    @app.post("/users")
+    async def create_user_endpoint(request: UserCreate, admin: User = Depends(require_admin)):
+        """创建用户（仅管理员）"""
+        try:
+            return await asyncio.to_thread(
+                create_user,
+                request.username,
+                request.password,
+                is_admin=request.is_admin,
+                session_quota=request.session_quota,
+                daily_message_quota=request.daily_message_quota
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    @app.get("/ready")
+    async def ready_endpoint():
+        """就绪探测，返回启动耗时指标（无需认证）"""
+        return FastJSONResponse(
+            {"ready": ready_event.is_set(), "startup": startup_metrics},
+            status_code=200 if ready_event.is_set() else 503
+        )
+
+    @app.get("/stats/prompt-cache")
+    async def prompt_cache_stats_endpoint(user: User = Depends(get_current_user)):
+        """获取提示词缓存命中统计"""
+        prompt_tokens = cache_stats["prompt_tokens"]
+        return {
+            **cache_stats,
+            "cached_ratio": cache_stats["cached_tokens"] / prompt_tokens if prompt_tokens else 0.0
+        }
+
+    @app.get("/sessions")
+    async def get_sessions_endpoint(user: User = Depends(get_current_user)):
+        """获取当前用户的所有聊天会话"""
+        return FastJSONResponse(sessions_to_list(get_sessions(user.id)))
 
-    @app.post("/sessions", dependencies=[auth_dependency] if auth_enabled else [])
-    async def create_session_endpoint(title: str = "新对话"):
+    @app.post("/sessions")
+    async def create_session_endpoint(title: str = "新对话", user: User = Depends(get_current_user)):
         """创建新聊天会话"""
-        return create_session(title)
+        if user.session_quota > 0 and count_sessions(user.id) >= user.session_quota:
+            raise HTTPException(status_code=403, detail=f"会话数量已达上限（{user.session_quota}）")
+        session = create_session(title, owner_id=user.id)
+        notify_session_change(user.id, "created", session)
+        return FastJSONResponse(session_to_dict(session))
+
+    @app.get("/sessions/search")
+    async def search_sessions_endpoint(q: str, limit: int = 50, user: User = Depends(get_current_user)):
+        """在当前用户的会话中按标题和消息内容搜索"""
+        # 归档会话的内容需要解压后匹配，放到线程中执行
+        sessions = await asyncio.to_thread(search_sessions, user.id, q, min(max(limit, 1), 200))
+        return FastJSONResponse([
+            {
+                "id": session.id,
+                "title": session.title,
+                "updated_at": session.updated_at,
+                "archived": session.archived
+            }
+            for session in sessions
+        ])
 
-    @app.get("/sessions/{session_id}", dependencies=[auth_dependency] if auth_enabled else [])
-    async def get_session_endpoint(session_id: str):
+    @app.get("/sessions/{session_id}")
+    async def get_session_endpoint(session_id: str, user: User = Depends(get_current_user)):
         """获取特定聊天会话"""
-        session = get_session(session_id)
+        session = get_session(session_id, user.id)
         if session:
-            return session
+            return FastJSONResponse(session_to_dict(session))
         return {"error": "会话未找到"}
 
-    @app.put("/sessions/{session_id}", dependencies=[auth_dependency] if auth_enabled else [])
-    async def update_session_endpoint(session_id: str, update: SessionUpdate):
+    @app.put("/sessions/{session_id}")
+    async def update_session_endpoint(session_id: str, update: SessionUpdate, user: User = Depends(get_current_user)):
         """更新会话配置"""
+        if not get_session(session_id, user.id):
+            return {"error": "会话未找到"}
         session = update_session(
             session_id, 
             update.title, 
@@ -81,151 +142,156 @@ def setup_routes(app: FastAPI):
             update.api_provider
         )
         if session:
-            return session
+            notify_session_change(user.id, "updated", session)
+            return FastJSONResponse(session_to_dict(session))
         return {"error": "会话未找到"}
 
-    @app.delete("/sessions/{session_id}", dependencies=[auth_dependency] if auth_enabled else [])
-    async def delete_session_endpoint(session_id: str):
+    @app.delete("/sessions/{session_id}")
+    async def delete_session_endpoint(session_id: str, user: User = Depends(get_current_user)):
         """删除聊天会话"""
+        if not get_session(session_id, user.id):
+            return {"error": "会话未找到"}
         if delete_session(session_id):
+            notify_session_change(user.id, "deleted", session_id=session_id)
             return {"message": "会话已删除"}
         return {"error": "会话未找到"}
 
-    @app.post("/sessions/{session_id}/messages", dependencies=[auth_dependency] if auth_enabled else [])
-    async def add_message_endpoint(session_id: str, message: Message):
+    @app.post("/sessions/{session_id}/messages")
+    async def add_message_endpoint(session_id: str, message: Message, user: User = Depends(get_current_user)):
         """向会话添加消息"""
+        if not get_session(session_id, user.id):
+            return {"error": "会话未找到"}
         updated_session = add_message_to_session(session_id, message)
         if updated_session:
-            return updated_session
+            notify_session_change(user.id, "updated", updated_session)
+            return FastJSONResponse(session_to_dict(updated_session))
         return {"error": "会话未找到"}
 
-    @app.put("/sessions/{session_id}/messages/{message_index}", dependencies=[auth_dependency] if auth_enabled else [])
-    async def edit_message_endpoint(session_id: str, message_index: int, message: Message):
+    @app.put("/sessions/{session_id}/messages/{message_index}")
+    async def edit_message_endpoint(session_id: str, message_index: int, message: Message, user: User = Depends(get_current_user)):
         """编辑会话中的消息"""
+        if not get_session(session_id, user.id):
+            return {"error": "会话未找到"}
         from .session_manager import edit_message_in_session
         updated_session = edit_message_in_session(session_id, message_index, message)
         if updated_session:
-            return updated_session
+            notify_session_change(user.id, "updated", updated_session)
+            return FastJSONResponse(session_to_dict(updated_session))
         return {"error": "会话或消息未找到"}
 
-    @app.delete("/sessions/{session_id}/messages/{message_index}", dependencies=[auth_dependency] if auth_enabled else [])
-    async def delete_message_endpoint(session_id: str, message_index: int):
+    @app.delete("/sessions/{session_id}/messages/{message_index}")
+    async def delete_message_endpoint(session_id: str, message_index: int, user: User = Depends(get_current_user)):
         """删除会话中的消息"""
+        if not get_session(session_id, user.id):
+            return {"error": "会话未找到"}
         from .session_manager import delete_message_from_session
         updated_session = delete_message_from_session(session_id, message_index)
         if updated_session:
-            return updated_session
+            notify_session_change(user.id, "updated", updated_session)
+            return FastJSONResponse(session_to_dict(updated_session))
         return {"error": "会话或消息未找到"}
 
-    @app.delete("/sessions/{session_id}/messages", dependencies=[auth_dependency] if auth_enabled else [])
-    async def clear_messages_endpoint(session_id: str):
+    @app.delete("/sessions/{session_id}/messages")
+    async def clear_messages_endpoint(session_id: str, user: User = Depends(get_current_user)):
         """清空会话消息"""
+        if not get_session(session_id, user.id):
+            return {"error": "会话未找到"}
         updated_session = clear_session_messages(session_id)
         if updated_session:
-            return updated_session
+            notify_session_change(user.id, "updated", updated_session)
+            return FastJSONResponse(session_to_dict(updated_session))
         return {"error": "会话未找到"}
 
-    @app.post("/chat", dependencies=[auth_dependency] if auth_enabled else [])
-    async def chat_endpoint(chat_request: ChatRequest):
-        """与LLM聊天（真实API调用）"""
+    @app.post("/chat")
+    async def chat_endpoint(chat_request: ChatRequest, request: Request, user: User = Depends(get_current_user)):
+        """与LLM聊天（真实API调用）
+
+        客户端断开或调用取消接口时中断生成，已生成的部分作为被中断的回复记录。
+        """
         session_id = chat_request.session_id
-        message = chat_request.message
-        file_urls = chat_request.file_urls
+        session, messages = await prepare_chat_turn(user, session_id, chat_request.message, chat_request.file_urls)
         
-        # 获取会话信息
-        session = get_session(session_id)
+        # 调用OpenAI API
+        session, assistant_message, usage, cancelled = await generate_reply(
+            Generation(session_id), session, messages, is_disconnected=request.is_disconnected
+        )
         if not session:
             raise HTTPException(status_code=404, detail="会话未找到")
+        notify_session_change(user.id, "updated", session)
         
-        # 添加用户消息
-        user_message = Message(
-            role="user",
-            content=message,
-            timestamp=datetime.now().isoformat(),
-            file_urls=file_urls
+        return FastJSONResponse({
+            "session": session_to_dict(session),
+            "response": message_to_dict(assistant_message),
+            "usage": record_usage(usage),
+            "cancelled": cancelled
+        })
+
+    @app.post("/sessions/{session_id}/cancel")
+    async def cancel_generation_endpoint(session_id: str, user: User = Depends(get_current_user)):
+        """中断会话中进行中的生成，HTTP和WebSocket发起的生成都适用"""
+        if not get_session(session_id, user.id):
+            return {"error": "会话未找到"}
+        return {"cancelled": cancel_session_generations(session_id)}
+
+    @app.get("/export")
+    async def export_sessions_endpoint(include_files: bool = True, compress: bool = True,
+                                       all_users: bool = False, user: User = Depends(get_current_user)):
+        """以NDJSON流式导出会话和消息，可包含引用的上传文件；all_users导出所有用户的会话（仅管理员）"""
+        if all_users and not user.is_admin:
+            raise HTTPException(status_code=403, detail="需要管理员权限")
+
+        filename = f"easychatbox-{datetime.now().strftime('%Y%m%d%H%M%S')}.ndjson"
+        if compress:
+            filename += ".gz"
+        # 同步生成器在线程池中逐块执行，分页读取数据库，不会阻塞事件循环
+        return StreamingResponse(
+            iter_export(None if all_users else user.id, include_files, compress),
+            media_type="application/gzip" if compress else "application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
         )
-        session = add_message_to_session(session_id, user_message)
-        
-        # 准备消息历史用于API调用
-        messages = []
-        for msg in session.messages:
-            # 如果消息有文件URL，需要特殊处理图片文件
-            if msg.file_urls:
-                # 创建包含文本和图片的内容数组
-                content_parts = [{"type": "text", "text": msg.content}]
-                
-                # 处理每个上传的文件
-                for file_url in msg.file_urls:
-                    # 转换URL为本地文件路径
-                    file_path = file_url.lstrip('/')
-                    
-                    # 检查文件是否存在且是图片
-                    if os.path.exists(file_path) and is_image_file(file_path):
-                        try:
-                            # 将图片编码为base64
-                            base64_image = encode_image_to_base64(file_path)
-                            # 添加图片到内容数组
-                            content_parts.append({
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            })
-                        except Exception as e:
-                            # 如果图片处理失败，添加错误信息到文本内容
-                            content_parts[0]["text"] += f"\n[图片处理失败: {str(e)}]"
-                    else:
-                        # 对于非图片文件，添加文件信息到文本内容
-                        content_parts[0]["text"] += f"\n\n[已上传文件]: {file_url}"
-                
-                # 添加消息到历史记录
-                messages.append({
-                    "role": msg.role,
-                    "content": content_parts
-                })
-            else:
-                # 没有文件的普通消息
-                messages.append({
-                    "role": msg.role,
-                    "content": msg.content
-                })
-        
-        # 调用OpenAI API
+
+    @app.post("/import")
+    async def import_sessions_endpoint(request: Request, keep_owners: bool = False,
+                                       user: User = Depends(get_current_user)):
+        """流式导入/export导出的数据（可为gzip压缩），会话获得新的ID并归属于当前用户；
+        keep_owners按用户名归属到已存在的用户（仅管理员）。消息分批写入数据库，会话打开时才加载到内存
+        """
+        if keep_owners and not user.is_admin:
+            raise HTTPException(status_code=403, detail="需要管理员权限")
+
+        session_limit = 0
+        if user.session_quota > 0:
+            session_limit = user.session_quota - count_sessions(user.id)
+            if session_limit <= 0:
+                raise HTTPException(status_code=403, detail=f"会话数量已达上限（{user.session_quota}）")
+
+        importer = Importer(user.id, keep_owners=keep_owners, session_limit=session_limit)
         try:
-            response_content = await call_openai_api(messages, session.model, session.api_provider)
-            
-            # 添加助手消息
-            assistant_message = Message(
-                role="assistant",
-                content=response_content,
-                timestamp=datetime.now().isoformat()
-            )
-            session = add_message_to_session(session_id, assistant_message)
-            
-            return {
-                "session": session,
-                "response": assistant_message
-            }
-        except Exception as e:
-            # 如果API调用失败，添加错误消息
-            error_message = Message(
-                role="assistant",
-                content=f"API调用失败: {str(e)}",
-                timestamp=datetime.now().isoformat()
-            )
-            add_message_to_session(session_id, error_message)
-            
-            raise HTTPException(status_code=500, detail=f"API调用失败: {str(e)}")
+            async for chunk in request.stream():
+                if chunk:
+                    await asyncio.to_thread(importer.feed, chunk)
+                    add_imported_sessions(importer.take_committed())
+            await asyncio.to_thread(importer.finish)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"导入失败: {e}（已导入{importer.stats['sessions']}个会话）")
+        finally:
+            # 出错时已提交的批次同样可用
+            add_imported_sessions(importer.take_committed())
+            await asyncio.to_thread(importer.close)
+        return importer.stats
 
-    @app.get("/config", dependencies=[auth_dependency] if auth_enabled else [])
-    async def get_config_endpoint():
+    @app.get("/config")
+    async def get_config_endpoint(user: User = Depends(get_current_user)):
         """获取配置信息"""
         # 根据实际配置返回可用的模型和提供商
+        registry = get_registry()
+        default_provider = registry.default_provider
+        default_model = registry.default_model
         available_providers = []
         available_models = {}
         
         # 从配置文件中获取提供商和模型信息
-        for provider in providers:
+        for provider in registry.providers:
             name = provider.get("name")
             models = provider.get("models", [])
             available_providers.append(name)
@@ -243,11 +309,11 @@ def setup_routes(app: FastAPI):
             "default_model": default_model
         }
 
-    @app.post("/upload", dependencies=[auth_dependency] if auth_enabled else [])
-    async def upload_file_endpoint(file: UploadFile = File(...)):
+    @app.post("/upload")
+    async def upload_file_endpoint(file: UploadFile = File(...), user: User = Depends(get_current_user)):
         """上传文件"""
         # 确保上传目录存在
-        upload_dir = "uploads"
+        upload_dir = UPLOAD_DIR
         if not os.path.exists(upload_dir):
             os.makedirs(upload_dir)
         
@@ -256,11 +322,25 @@ def setup_routes(app: FastAPI):
         unique_filename = f"{uuid.uuid4()}{file_extension}"
         file_path = os.path.join(upload_dir, unique_filename)
         
-        # 保存文件
+        # 分块写入文件，同时计算内容哈希，避免将整个文件读入内存
+        hasher = hashlib.sha256()
+        size = 0
         with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+            while True:
+                chunk = await file.read(1024 * 1024)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                buffer.write(chunk)
+                size += len(chunk)
         
         # 返回文件URL
         file_url = f"/{file_path.replace(os.sep, '/')}"
-        return {"file_url": file_url}
+        
+        # 非图片文件在后台提取文本，相同内容只提取一次
+        extract_status = None
+        if not is_image_file(file_path):
+            extract_status = await asyncio.to_thread(
+                register_upload, file_url, hasher.hexdigest(), file.filename, size, file_path
+            )
+        return {"file_url": file_url, "extract_status": extract_status}
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+from typing import List, Optional, Set
+from datetime import datetime
+from .database import DB_PATH, UPLOAD_DIR, get_db_connection
+from .serialization import dumps
+from .documents import delete_file_records
+
+# zstandard是可选依赖，未安装时使用zlib压缩
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def init_archive_db():
+    """创建归档表"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    # 每个归档会话的全部消息压缩为一个数据块
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_messages (
+            session_id TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            message_count INTEGER NOT NULL,
+            file_urls TEXT,  -- JSON string of referenced file URLs
+            archived_at TEXT NOT NULL,
+            FOREIGN KEY (session_id) REFERENCES sessions (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # 维护任务的状态（如上次完整VACUUM的时间），重启后仍然有效
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+
+    conn.commit()
+    conn.close()
+
+def get_maintenance_state(key: str) -> Optional[str]:
+    conn = get_db_connection()
+    row = conn.execute("SELECT value FROM maintenance_state WHERE key = ?", (key,)).fetchone()
+    conn.close()
+    return row['value'] if row else None
+
+def set_maintenance_state(key: str, value: str):
+    conn = get_db_connection()
+    conn.execute("INSERT OR REPLACE INTO maintenance_state (key, value) VALUES (?, ?)", (key, value))
+    conn.commit()
+    conn.close()
+
+def compress_payload(data: bytes) -> tuple:
+    """压缩数据，返回(编码名称, 压缩后数据)"""
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+def decompress_payload(codec: str, payload: bytes) -> bytes:
+    """按编码名称解压数据"""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("归档数据使用zstd压缩，但未安装zstandard")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+def load_archived_session_ids() -> Set[str]:
+    """获取所有已归档会话的ID"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT session_id FROM archived_messages")
+    session_ids = {row['session_id'] for row in cursor.fetchall()}
+
+    conn.close()
+    return session_ids
+
+def archive_session_in_db(session_id: str) -> int:
+    """将会话的消息压缩后移入归档表，返回归档的消息数"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT role, content, file_urls, timestamp FROM messages
+        WHERE session_id = ?
+        ORDER BY id
+    ''', (session_id,))
+
+    messages = []
+    file_urls = []
+    for row in cursor.fetchall():
+        urls = json.loads(row['file_urls']) if row['file_urls'] else None
+        if urls:
+            file_urls.extend(urls)
+        messages.append({
+            'role': row['role'],
+            'content': row['content'],
+            'timestamp': row['timestamp'],
+            'file_urls': urls
+        })
+
+    codec, payload = compress_payload(dumps(messages))
+
+    # 写入归档和删除热数据在同一事务中完成
+    cursor.execute('''
+        INSERT OR REPLACE INTO archived_messages
+        (session_id, codec, payload, message_count, file_urls, archived_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (
+        session_id,
+        codec,
+        payload,
+        len(messages),
+        json.dumps(file_urls) if file_urls else None,
+        datetime.now().isoformat()
+    ))
+    cursor.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+    conn.commit()
+    conn.close()
+
+    return len(messages)
+
+def restore_session_from_db(session_id: str) -> Optional[List[dict]]:
+    """将归档会话的消息解压回消息表，返回消息列表"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT codec, payload FROM archived_messages WHERE session_id = ?", (session_id,))
+    row = cursor.fetchone()
+    if not row:
+        conn.close()
+        return None
+
+    messages = json.loads(decompress_payload(row['codec'], row['payload']))
+
+    # 写回热数据和删除归档在同一事务中完成
+    cursor.executemany('''
+        INSERT INTO messages
+        (session_id, role, content, file_urls, timestamp)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        (
+            session_id,
+            message['role'],
+            message['content'],
+            json.dumps(message['file_urls']) if message['file_urls'] else None,
+            message['timestamp']
+        )
+        for message in messages
+    ])
+    cursor.execute("DELETE FROM archived_messages WHERE session_id = ?", (session_id,))
+
+    conn.commit()
+    conn.close()
+
+    return messages
+
+def delete_archived_session_from_db(session_id: str):
+    """删除会话的归档数据"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("DELETE FROM archived_messages WHERE session_id = ?", (session_id,))
+
+    conn.commit()
+    conn.close()
+
+def get_referenced_file_urls() -> Set[str]:
+    """获取热数据和归档数据中仍被引用的文件URL"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    referenced = set()
+    cursor.execute("SELECT file_urls FROM messages WHERE file_urls IS NOT NULL")
+    for row in cursor:
+        referenced.update(json.loads(row['file_urls']))
+
+    # 归档表单独记录了引用的文件，无需解压数据块
+    cursor.execute("SELECT file_urls FROM archived_messages WHERE file_urls IS NOT NULL")
+    for row in cursor:
+        referenced.update(json.loads(row['file_urls']))
+
+    conn.close()
+    return referenced
+
+def collect_orphan_uploads(grace_hours: float) -> int:
+    """删除不再被任何消息引用的上传文件，返回删除的文件数"""
+    if not os.path.isdir(UPLOAD_DIR):
+        return 0
+
+    referenced = get_referenced_file_urls()
+    # 刚上传但尚未随消息发送的文件在宽限期内保留
+    cutoff = time.time() - grace_hours * 3600
+
+    removed = []
+    for entry in os.scandir(UPLOAD_DIR):
+        if not entry.is_file():
+            continue
+        file_url = f"/{UPLOAD_DIR}/{entry.name}"
+        if file_url in referenced or entry.stat().st_mtime > cutoff:
+            continue
+        try:
+            os.remove(entry.path)
+            removed.append(file_url)
+        except OSError as e:
+            print(f"删除上传文件 {entry.path} 失败: {e}")
+
+    # 同时清理这些文件的提取结果
+    delete_file_records(removed)
+    return len(removed)
+
+def compact_db(full: bool = False):
+    """回收数据库空闲页
+
+    默认只执行增量回收，不会长时间锁住数据库；增量回收需要数据库处于auto_vacuum=INCREMENTAL模式，
+    新建的数据库默认如此，已有的数据库在full为True（配置中开启full_vacuum）时通过完整VACUUM切换。
+    完整VACUUM在整个过程中独占数据库，期间的写入会失败。
+    """
+    conn = sqlite3.connect(DB_PATH)
+
+    if full:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+
+    # 更新查询规划所需的统计信息
+    conn.execute("PRAGMA optimize")
+    conn.close()
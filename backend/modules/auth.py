@@ -0,0 +1,302 @@
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import uuid
+from typing import Dict, Optional, Tuple
+from datetime import datetime, timedelta
+from fastapi import Depends, HTTPException, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from .database import DB_PATH, get_db_connection
+from .models import User
+from .config import (
+    auth_enabled, auth_username, auth_password, token_ttl_hours,
+    default_session_quota, default_daily_message_quota
+)
+
+# PBKDF2迭代次数，只在登录时计算一次
+PASSWORD_ITERATIONS = 200000
+
+# 创建Bearer令牌认证实例
+security = HTTPBearer(auto_error=False)
+
+# 用户缓存：用户ID -> 用户
+users_by_id: Dict[str, User] = {}
+
+# 已验证的令牌缓存：令牌哈希 -> (用户ID, 过期时间)
+token_cache: Dict[str, Tuple[str, str]] = {}
+
+# 由配置文件引导创建的管理员用户ID
+admin_user_id: str = None
+
+def init_auth_db():
+    """创建用户和令牌表，引导管理员账户并认领无主会话"""
+    global admin_user_id
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            is_admin INTEGER NOT NULL DEFAULT 0,
+            session_quota INTEGER NOT NULL DEFAULT 0,
+            daily_message_quota INTEGER NOT NULL DEFAULT 0,
+            quota_day TEXT,
+            quota_used INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        )
+    ''')
+
+    # 只保存令牌的哈希，数据库泄露时令牌不可直接使用
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS auth_tokens (
+            token_hash TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_auth_tokens_user_id
+        ON auth_tokens (user_id)
+    ''')
+
+    conn.commit()
+    conn.close()
+
+    # 配置文件中的账户作为管理员，密码以配置文件为准
+    admin = get_user_by_username(auth_username)
+    if admin is None:
+        admin = create_user(auth_username, auth_password, is_admin=True, session_quota=0, daily_message_quota=0)
+    elif not verify_user_password(auth_username, auth_password):
+        set_user_password(admin.id, auth_password)
+    admin_user_id = admin.id
+
+    # 多用户之前创建的会话归管理员所有
+    conn = get_db_connection()
+    conn.execute("UPDATE sessions SET owner_id = ? WHERE owner_id IS NULL", (admin_user_id,))
+    conn.commit()
+    conn.close()
+
+def hash_password(password: str, salt: str = None) -> str:
+    """使用PBKDF2-SHA256计算密码哈希"""
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("utf-8"), PASSWORD_ITERATIONS)
+    return f"pbkdf2_sha256${PASSWORD_ITERATIONS}${salt}${digest.hex()}"
+
+def check_password(password: str, password_hash: str) -> bool:
+    """校验密码是否与哈希匹配"""
+    try:
+        algorithm, iterations, salt, expected = password_hash.split("$")
+    except ValueError:
+        return False
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("utf-8"), int(iterations))
+    return hmac.compare_digest(digest.hex(), expected)
+
+def hash_token(token: str) -> str:
+    """计算令牌的哈希，令牌本身随机性足够，无需加盐"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def row_to_user(row) -> User:
+    """将数据库行转换为用户"""
+    return User(
+        id=row['id'],
+        username=row['username'],
+        is_admin=bool(row['is_admin']),
+        session_quota=row['session_quota'],
+        daily_message_quota=row['daily_message_quota']
+    )
+
+def get_user(user_id: str) -> Optional[User]:
+    """按ID获取用户，优先使用缓存"""
+    user = users_by_id.get(user_id)
+    if user is not None:
+        return user
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+    row = cursor.fetchone()
+    conn.close()
+
+    if not row:
+        return None
+    user = row_to_user(row)
+    users_by_id[user.id] = user
+    return user
+
+def get_user_by_username(username: str) -> Optional[User]:
+    """按用户名获取用户"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    conn.close()
+
+    if not row:
+        return None
+    user = row_to_user(row)
+    users_by_id[user.id] = user
+    return user
+
+def create_user(username: str, password: str, is_admin: bool = False,
+                session_quota: int = None, daily_message_quota: int = None) -> User:
+    """创建用户，用户名已存在时抛出ValueError"""
+    user = User(
+        id=str(uuid.uuid4()),
+        username=username,
+        is_admin=is_admin,
+        session_quota=default_session_quota if session_quota is None else session_quota,
+        daily_message_quota=default_daily_message_quota if daily_message_quota is None else daily_message_quota
+    )
+
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            INSERT INTO users
+            (id, username, password_hash, is_admin, session_quota, daily_message_quota, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user.id,
+            user.username,
+            hash_password(password),
+            int(user.is_admin),
+            user.session_quota,
+            user.daily_message_quota,
+            datetime.now().isoformat()
+        ))
+        conn.commit()
+    except sqlite3.IntegrityError:
+        raise ValueError("用户名已存在")
+    finally:
+        conn.close()
+
+    users_by_id[user.id] = user
+    return user
+
+def set_user_password(user_id: str, password: str):
+    """修改用户密码并使其所有令牌失效"""
+    conn = get_db_connection()
+    conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (hash_password(password), user_id))
+    conn.execute("DELETE FROM auth_tokens WHERE user_id = ?", (user_id,))
+    conn.commit()
+    conn.close()
+
+    for token_hash in [h for h, (uid, _) in token_cache.items() if uid == user_id]:
+        del token_cache[token_hash]
+
+def verify_user_password(username: str, password: str) -> Optional[User]:
+    """校验用户名和密码，成功时返回用户"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    conn.close()
+
+    # 用户不存在时也计算一次哈希，避免通过响应时间探测用户名
+    if not row:
+        check_password(password, hash_password(""))
+        return None
+    if not check_password(password, row['password_hash']):
+        return None
+    return get_user(row['id'])
+
+def login(username: str, password: str) -> Optional[str]:
+    """校验凭据并签发令牌，失败时返回None"""
+    user = verify_user_password(username, password)
+    if user is None:
+        return None
+
+    token = secrets.token_urlsafe(32)
+    token_hash = hash_token(token)
+    now = datetime.now()
+    expires_at = (now + timedelta(hours=token_ttl_hours)).isoformat()
+
+    conn = get_db_connection()
+    # 顺便清理该用户已过期的令牌
+    conn.execute("DELETE FROM auth_tokens WHERE user_id = ? AND expires_at < ?", (user.id, now.isoformat()))
+    conn.execute('''
+        INSERT INTO auth_tokens (token_hash, user_id, created_at, expires_at)
+        VALUES (?, ?, ?, ?)
+    ''', (token_hash, user.id, now.isoformat(), expires_at))
+    conn.commit()
+    conn.close()
+
+    token_cache[token_hash] = (user.id, expires_at)
+    return token
+
+def logout(token: str):
+    """吊销令牌"""
+    token_hash = hash_token(token)
+    token_cache.pop(token_hash, None)
+
+    conn = get_db_connection()
+    conn.execute("DELETE FROM auth_tokens WHERE token_hash = ?", (token_hash,))
+    conn.commit()
+    conn.close()
+
+def resolve_token(token: str) -> Optional[User]:
+    """将令牌解析为用户，命中缓存时不访问数据库"""
+    token_hash = hash_token(token)
+    cached = token_cache.get(token_hash)
+
+    if cached is None:
+        # 服务重启后缓存为空，从数据库恢复
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, expires_at FROM auth_tokens WHERE token_hash = ?", (token_hash,))
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return None
+        cached = (row['user_id'], row['expires_at'])
+        token_cache[token_hash] = cached
+
+    user_id, expires_at = cached
+    if expires_at < datetime.now().isoformat():
+        logout(token)
+        return None
+    return get_user(user_id)
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> User:
+    """认证依赖函数，返回当前用户；未启用认证时所有请求归管理员"""
+    if not auth_enabled:
+        return get_user(admin_user_id)
+
+    user = resolve_token(credentials.credentials) if credentials else None
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
+def require_admin(user: User = Depends(get_current_user)) -> User:
+    """要求当前用户为管理员"""
+    if not user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="需要管理员权限")
+    return user
+
+def consume_message_quota(user: User) -> bool:
+    """消耗一次当天的聊天配额，配额用尽时返回False"""
+    if user.daily_message_quota <= 0:
+        return True
+
+    today = datetime.now().date().isoformat()
+    conn = get_db_connection()
+    # 跨天时重置计数，单条语句完成检查和递增
+    cursor = conn.execute('''
+        UPDATE users
+        SET quota_used = CASE WHEN quota_day = ? THEN quota_used + 1 ELSE 1 END,
+            quota_day = ?
+        WHERE id = ? AND (quota_day IS NOT ? OR quota_used < ?)
+    ''', (today, today, user.id, today, user.daily_message_quota))
+    allowed = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return allowed
@@ -0,0 +1,162 @@
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from fastapi import HTTPException
+from pydantic import ValidationError
+from .models import Message, ChatSession, User
+from .session_manager import get_session, add_message_to_session
+from .memory import is_memory_active, retrieve_memories, build_memory_message
+from .prompt_builder import build_prompt_messages
+from .openai_client import stream_openai_api
+from .config import max_concurrent_generations
+from .auth import consume_message_quota
+
+# 被中断的回复末尾追加的说明，同时让模型在后续轮次知道上一条回复不完整
+TRUNCATED_NOTE = "[回复已中断]"
+
+# 检查HTTP客户端是否断开的间隔（秒）
+DISCONNECT_POLL_SECONDS = 0.5
+
+# 同时向提供商发起的生成请求数上限，生成被取消时立即释放
+generation_slots = asyncio.Semaphore(max_concurrent_generations)
+
+# 进行中的生成：会话ID -> 生成集合
+active_generations: Dict[str, Set["Generation"]] = {}
+
+class Generation:
+    """一次进行中的生成，累积已收到的内容，取消时关闭上游请求"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.parts: List[str] = []
+        self.usage: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def cancel(self) -> bool:
+        """取消生成，已收到的内容保留"""
+        return self.task is not None and self.task.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.task is not None and self.task.cancelled()
+
+async def prepare_chat_turn(user: User, session_id: str, message: str, file_urls: Optional[List[str]] = None) -> tuple:
+    """校验并记录用户消息，返回(会话, 发给模型的消息列表)
+
+    HTTP聊天接口和WebSocket共用，会话不存在、消息无效或配额用尽时抛出HTTPException。
+    """
+    # 获取会话信息
+    session = get_session(session_id, user.id)
+    if not session:
+        raise HTTPException(status_code=404, detail="会话未找到")
+
+    # 先校验消息，无效的请求不消耗配额
+    try:
+        user_message = Message(
+            role="user",
+            content=message,
+            timestamp=datetime.now().isoformat(),
+            file_urls=file_urls
+        )
+    except ValidationError:
+        raise HTTPException(status_code=422, detail="无效的消息内容或文件列表")
+
+    # 检查当天的聊天配额
+    if not consume_message_quota(user):
+        raise HTTPException(status_code=429, detail=f"今日消息数量已达上限（{user.daily_message_quota}）")
+
+    # 添加用户消息
+    session = add_message_to_session(session_id, user_message)
+
+    # 准备消息历史用于API调用，复用上一轮已渲染的前缀
+    messages = await asyncio.to_thread(build_prompt_messages, session)
+
+    # 注入相关的历史对话片段，放在最新的用户消息之后，保持历史前缀不变以命中提示词缓存
+    if is_memory_active():
+        try:
+            memories = await asyncio.to_thread(retrieve_memories, user.id, message, session_id)
+            if memories:
+                messages.append(build_memory_message(memories))
+        except Exception as e:
+            print(f"检索记忆失败: {e}")
+
+    return session, messages
+
+def add_assistant_message(session_id: str, content: str) -> tuple:
+    """记录助手回复，返回(会话, 消息)"""
+    assistant_message = Message(
+        role="assistant",
+        content=content,
+        timestamp=datetime.now().isoformat()
+    )
+    session: ChatSession = add_message_to_session(session_id, assistant_message)
+    return session, assistant_message
+
+async def stream_into(generation: Generation, messages: List[dict], model: str, provider: str,
+                      on_delta: Optional[Callable[[str], None]] = None):
+    """占用一个生成名额并流式读取回复"""
+    async with generation_slots:
+        stream = stream_openai_api(messages, model, provider)
+        try:
+            async for delta, usage in stream:
+                if usage is not None:
+                    generation.usage = usage
+                if delta:
+                    generation.parts.append(delta)
+                    if on_delta is not None:
+                        on_delta(delta)
+        finally:
+            # 无论在哪里被取消都立即关闭上游连接，提供商随即停止生成
+            await stream.aclose()
+
+def record_reply(generation: Generation) -> tuple:
+    """记录已生成的回复，被中断时标注，返回(会话, 消息)"""
+    content = "".join(generation.parts)
+    if generation.cancelled:
+        content = f"{content}\n\n{TRUNCATED_NOTE}" if content else TRUNCATED_NOTE
+    return add_assistant_message(generation.session_id, content)
+
+async def generate_reply(generation: Generation, session: ChatSession, messages: List[dict],
+                         on_delta: Optional[Callable[[str], None]] = None,
+                         is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None) -> tuple:
+    """生成并记录助手回复，返回(会话, 助手消息, 用量, 是否被中断)
+
+    生成可以通过Generation.cancel()、调用方任务被取消或is_disconnected返回True中断，
+    中断时上游请求立即关闭、名额立即释放，已生成的部分作为被中断的回复记录。
+    提供商出错时记录错误消息并抛出HTTPException。
+    """
+    generation.task = asyncio.create_task(
+        stream_into(generation, messages, session.model, session.api_provider, on_delta)
+    )
+    active_generations.setdefault(session.id, set()).add(generation)
+    try:
+        while not generation.task.done():
+            await asyncio.wait({generation.task}, timeout=DISCONNECT_POLL_SECONDS if is_disconnected else None)
+            if not generation.task.done() and is_disconnected is not None and await is_disconnected():
+                generation.cancel()
+    except asyncio.CancelledError:
+        # 调用方被取消（例如WebSocket断开）时一并取消生成，记录后继续向上传播
+        generation.cancel()
+        await asyncio.wait({generation.task})
+        record_reply(generation)
+        raise
+    finally:
+        sessions = active_generations.get(session.id)
+        if sessions is not None:
+            sessions.discard(generation)
+            if not sessions:
+                del active_generations[session.id]
+
+    if not generation.cancelled and generation.task.exception() is not None:
+        error = generation.task.exception()
+        detail = error.detail if isinstance(error, HTTPException) else str(error)
+        # 如果API调用失败，添加错误消息
+        add_assistant_message(session.id, f"API调用失败: {detail}")
+        raise HTTPException(status_code=500, detail=f"API调用失败: {detail}")
+
+    session, assistant_message = record_reply(generation)
+    return session, assistant_message, generation.usage, generation.cancelled
+
+def cancel_session_generations(session_id: str) -> int:
+    """取消会话中所有进行中的生成，返回取消的数量"""
+    return sum(1 for generation in list(active_generations.get(session_id, ())) if generation.cancel())
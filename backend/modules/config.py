@@ -1,15 +1,23 @@
 import os
 import json
+import asyncio
+import threading
+from urllib.parse import urlparse
 from dotenv import load_dotenv
-import openai
 
 # 加载环境变量
 load_dotenv()
 
+# 配置文件路径
+CONFIG_PATH = "config.json"
+
+# 已知支持stream_options的服务，其他OpenAI兼容服务需在提供商配置中设置stream_usage
+STREAM_USAGE_HOSTS = {"api.openai.com", "openrouter.ai"}
+
 # 加载配置文件
 def load_config():
     try:
-        with open('config.json', 'r', encoding='utf-8') as f:
+        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
             return json.load(f)
     except FileNotFoundError:
         return {"providers": []}
@@ -17,43 +25,216 @@ def load_config():
 # 获取配置
 config = load_config()
 
-# 获取提供商列表
-providers = config.get("providers", [])
-
 # 获取认证配置
 auth_config = config.get("auth", {})
 auth_enabled = auth_config.get("enabled", False)
 auth_username = auth_config.get("username", "admin")
 auth_password = auth_config.get("password", "password")
+token_ttl_hours = auth_config.get("token_ttl_hours", 168)
+default_session_quota = auth_config.get("default_session_quota", 0)
+default_daily_message_quota = auth_config.get("default_daily_message_quota", 0)
+
+# 获取响应序列化配置
+serialization_config = config.get("serialization", {})
+compression_enabled = serialization_config.get("compression", True)
+compression_min_size = serialization_config.get("compression_min_size", 1024)
+
+# 获取归档配置
+archive_config = config.get("archive", {})
+archive_enabled = archive_config.get("enabled", True)
+archive_idle_days = archive_config.get("idle_days", 30)
+archive_interval_hours = archive_config.get("interval_hours", 24)
+upload_grace_hours = archive_config.get("upload_grace_hours", 24)
+vacuum_interval_days = archive_config.get("vacuum_interval_days", 7)
+# 完整VACUUM会在执行期间锁住整个数据库，需要显式开启
+full_vacuum_enabled = archive_config.get("full_vacuum", False)
+
+# 获取记忆（语义检索）配置
+memory_config = config.get("memory", {})
+memory_enabled = memory_config.get("enabled", False)
+memory_top_k = memory_config.get("top_k", 3)
+memory_min_score = memory_config.get("min_score", 0.1)
+memory_embedding_provider = memory_config.get("embedding_provider", "local")
+memory_embedding_model = memory_config.get("embedding_model", "text-embedding-3-small")
+memory_dimensions = memory_config.get("dimensions", 256)
+
+# 获取文档提取配置
+documents_config = config.get("documents", {})
+document_chunk_tokens = documents_config.get("chunk_tokens", 500)
+document_context_budget = documents_config.get("context_token_budget", 8000)
+document_turn_budget = documents_config.get("turn_token_budget", 4000)
+
+# 获取服务器配置
+server_config = config.get("server", {})
+config_reload_seconds = server_config.get("config_reload_seconds", 2)
+ready_timeout_seconds = server_config.get("ready_timeout_seconds", 30)
+max_concurrent_generations = server_config.get("max_concurrent_generations", 32)
+
+# 获取WebSocket配置
+websocket_config = config.get("websocket", {})
+websocket_send_queue_size = websocket_config.get("send_queue_size", 256)
+websocket_auth_timeout_seconds = websocket_config.get("auth_timeout_seconds", 10)
+
+def valid_providers(providers) -> list:
+    """过滤掉格式不正确的提供商配置，避免一处笔误使整个注册表无法创建"""
+    if not isinstance(providers, list):
+        print("配置中的providers不是列表，已忽略")
+        return []
+
+    result = []
+    for provider in providers:
+        if not isinstance(provider, dict) or not isinstance(provider.get("name"), str):
+            print(f"忽略格式不正确的提供商配置: {provider!r}")
+            continue
+        models = provider.get("models")
+        if models is not None and (not isinstance(models, list) or not all(isinstance(model, str) for model in models)):
+            print(f"提供商 {provider['name']} 的models不是字符串列表，已忽略")
+            provider = {**provider, "models": []}
+        if not isinstance(provider.get("parameters", {}), dict):
+            print(f"提供商 {provider['name']} 的parameters不是对象，已忽略")
+            provider = {**provider, "parameters": {}}
+        if not isinstance(provider.get("stream_usage", False), bool):
+            print(f"提供商 {provider['name']} 的stream_usage不是布尔值，已忽略")
+            provider = {key: value for key, value in provider.items() if key != "stream_usage"}
+        result.append(provider)
+    return result
+
+class ProviderRegistry:
+    """提供商配置的快照，客户端在首次使用时才创建
+
+    热重载时整体替换注册表，进行中的请求继续使用旧快照中的客户端。
+    """
+
+    def __init__(self, providers: list, previous: "ProviderRegistry" = None):
+        providers = valid_providers(providers)
+        self.providers = providers
+        
+        # 初始化默认值
+        self.default_provider = "OpenAI"
+        self.default_model = "gpt-4o"
+        
+        # 如果有配置的提供商，使用第一个作为默认
+        if providers:
+            self.default_provider = providers[0].get("name", self.default_provider)
+            self.default_model = (providers[0].get("models") or [self.default_model])[0]
+        
+        self.provider_configs = {provider.get("name"): provider for provider in providers}
+        self.provider_parameters = {
+            provider.get("name"): provider.get("parameters", {}) for provider in providers
+        }
+        # 流式请求是否附带stream_options以在最后一段返回用量
+        self.stream_usage = {
+            provider.get("name"): supports_stream_usage(provider) for provider in providers
+        }
+        
+        self._clients = {}
+        self._async_clients = {}
+        self._lock = threading.Lock()
+        
+        # 连接参数未变化的提供商沿用旧客户端，保留其连接池
+        if previous is not None:
+            for clients, previous_clients in ((self._clients, previous._clients), (self._async_clients, previous._async_clients)):
+                for name, client in previous_clients.items():
+                    old_config = previous.provider_configs.get(name, {})
+                    new_config = self.provider_configs.get(name, {})
+                    if client_settings(old_config) == client_settings(new_config):
+                        clients[name] = client
 
-# 初始化默认值
-default_provider = "OpenAI"
-default_model = "gpt-4o"
-
-# 如果有配置的提供商，使用第一个作为默认
-if providers:
-    default_provider = providers[0].get("name", default_provider)
-    default_model = providers[0].get("models", [default_model])[0]
-
-# 初始化OpenAI客户端字典和参数
-openai_clients = {}
-provider_parameters = {}
-
-# 根据配置初始化客户端
-for provider in providers:
-    name = provider.get("name")
-    api_key = provider.get("api_key")
-    base_url = provider.get("baseURL")
-    parameters = provider.get("parameters", {})
+    def has_client(self, name: str) -> bool:
+        """提供商是否配置了可用的API密钥"""
+        api_key = self.provider_configs.get(name, {}).get("api_key")
+        return bool(api_key) and api_key != "your-sk-here"
+
+    def get_client(self, name: str):
+        """获取提供商的客户端，首次使用时创建"""
+        return self._get_or_create(self._clients, name, "OpenAI")
+
+    def get_async_client(self, name: str):
+        """获取提供商的异步客户端，用于流式输出，首次使用时创建"""
+        return self._get_or_create(self._async_clients, name, "AsyncOpenAI")
+
+    def _get_or_create(self, clients: dict, name: str, client_class: str):
+        client = clients.get(name)
+        if client is not None or not self.has_client(name):
+            return client
+        
+        with self._lock:
+            if name not in clients:
+                # 延迟导入openai以缩短冷启动时间
+                import openai
+                
+                api_key, base_url = client_settings(self.provider_configs[name])
+                try:
+                    clients[name] = getattr(openai, client_class)(api_key=api_key, base_url=base_url)
+                except Exception as e:
+                    print(f"初始化 {name} 客户端失败: {e}")
+                    return None
+            return clients[name]
+
+def supports_stream_usage(provider: dict) -> bool:
+    """未在配置中指定stream_usage时，只对已知支持stream_options的服务开启，其他兼容服务可能拒绝未知参数"""
+    if "stream_usage" in provider:
+        return provider["stream_usage"]
+    base_url = provider.get("baseURL") or "https://api.openai.com/v1"
+    host = urlparse(base_url).hostname or ""
+    return host in STREAM_USAGE_HOSTS
+
+def client_settings(provider: dict) -> tuple:
+    """提取决定客户端连接的配置项"""
+    return provider.get("api_key"), provider.get("baseURL")
+
+# 当前的提供商注册表
+registry = ProviderRegistry(config.get("providers", []))
+config_mtime = os.path.getmtime(CONFIG_PATH) if os.path.exists(CONFIG_PATH) else None
+
+def get_registry() -> ProviderRegistry:
+    """获取当前的提供商注册表"""
+    return registry
+
+def reload_config() -> bool:
+    """重新加载配置文件并原子替换提供商注册表
+
+    认证、归档等其他配置仍需重启服务才会生效。
+    """
+    global config, registry, config_mtime
     
-    # 存储提供商参数
-    provider_parameters[name] = parameters
+    try:
+        mtime = os.path.getmtime(CONFIG_PATH)
+    except OSError as e:
+        print(f"重新加载配置失败: {e}")
+        return False
     
-    if api_key and api_key != "your-sk-here":
-        try:
-            openai_clients[name] = openai.OpenAI(api_key=api_key, base_url=base_url)
-        except Exception as e:
-            print(f"初始化 {name} 客户端失败: {e}")
+    try:
+        new_config = load_config()
+        if not isinstance(new_config, dict):
+            raise ValueError("配置文件的顶层必须是对象")
+        new_registry = ProviderRegistry(new_config.get("providers", []), previous=registry)
+    except Exception as e:
+        # 配置文件有误时保留当前注册表，文件再次修改后重试
+        config_mtime = mtime
+        print(f"重新加载配置失败: {e}")
+        return False
+    
+    # 单次赋值即完成替换，进行中的请求不受影响
+    config = new_config
+    registry = new_registry
+    config_mtime = mtime
+    print("配置已重新加载")
+    return True
 
-# 获取默认客户端
-default_client = openai_clients.get(default_provider) if openai_clients else None
+async def watch_config():
+    """轮询配置文件的修改时间，变化时热重载"""
+    global config_mtime
+    while True:
+        await asyncio.sleep(config_reload_seconds)
+        try:
+            mtime = os.path.getmtime(CONFIG_PATH)
+        except OSError:
+            continue
+        if mtime != config_mtime:
+            try:
+                reload_config()
+            except Exception as e:
+                # 任何意外错误都不能终止监听，记录修改时间以免反复重试同一份文件
+                config_mtime = mtime
+                print(f"重新加载配置失败: {e}")
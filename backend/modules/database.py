@@ -8,11 +8,17 @@ from .models import ChatSession, Message
 # 数据库文件路径
 DB_PATH = "sessions.db"
 
+# 上传文件目录
+UPLOAD_DIR = "uploads"
+
 def init_db():
     """初始化数据库，创建必要的表"""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
+    # 新建的数据库使用增量回收模式，维护任务无需完整VACUUM即可释放空闲页（对已有数据库不生效）
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    
     # 创建会话表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sessions (
@@ -45,12 +51,25 @@ def init_db():
         # 列已存在，忽略错误
         pass
     
+    # 检查sessions表是否有owner_id列，如果没有则添加
+    try:
+        cursor.execute("ALTER TABLE sessions ADD COLUMN owner_id TEXT")
+    except sqlite3.OperationalError:
+        # 列已存在，忽略错误
+        pass
+    
     # 创建索引以提高查询性能
     cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_messages_session_id 
         ON messages (session_id)
     ''')
     
+    # 按用户列出和搜索会话时使用的复合索引（用户过滤 + 按更新时间排序）
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_owner_updated 
+        ON sessions (owner_id, updated_at)
+    ''')
+    
     conn.commit()
     conn.close()
 
@@ -60,6 +79,32 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row  # 使结果可以通过列名访问
     return conn
 
+def message_row_to_dict(msg_row: sqlite3.Row) -> dict:
+    """将消息行转换为字典"""
+    # Parse file_urls from JSON string if it exists
+    file_urls = None
+    if msg_row['file_urls']:
+        try:
+            file_urls = json.loads(msg_row['file_urls'])
+        except json.JSONDecodeError:
+            file_urls = None
+
+    return {
+        'role': msg_row['role'],
+        'content': msg_row['content'],
+        'timestamp': msg_row['timestamp'],
+        'file_urls': file_urls
+    }
+
+def load_session_messages_from_db(session_id: str) -> List[dict]:
+    """读取会话在消息表中的所有消息"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM messages WHERE session_id = ? ORDER BY id", (session_id,))
+    messages = [message_row_to_dict(msg_row) for msg_row in cursor.fetchall()]
+    conn.close()
+    return messages
+
 def load_sessions_from_db() -> dict:
     """从数据库加载所有会话"""
     conn = get_db_connection()
@@ -75,36 +120,20 @@ def load_sessions_from_db() -> dict:
         cursor.execute("SELECT * FROM messages WHERE session_id = ? ORDER BY id", (row['id'],))
         message_rows = cursor.fetchall()
         
-        import json
-
-        messages = []
-        for msg_row in message_rows:
-            # Parse file_urls from JSON string if it exists
-            file_urls = None
-            if msg_row['file_urls']:
-                try:
-                    file_urls = json.loads(msg_row['file_urls'])
-                except json.JSONDecodeError:
-                    file_urls = None
-            
-            messages.append(
-                Message(
-                    role=msg_row['role'],
-                    content=msg_row['content'],
-                    timestamp=msg_row['timestamp'],
-                    file_urls=file_urls
-                )
-            )
+        # 直接由行构建轻量字典，整个会话交给模型一次性校验，
+        # 避免为每条消息单独构造Message对象
+        messages = [message_row_to_dict(msg_row) for msg_row in message_rows]
         
-        session = ChatSession(
-            id=row['id'],
-            title=row['title'],
-            messages=messages,
-            created_at=row['created_at'],
-            updated_at=row['updated_at'],
-            model=row['model'],
-            api_provider=row['api_provider']
-        )
+        session = ChatSession.model_validate({
+            'id': row['id'],
+            'title': row['title'],
+            'messages': messages,
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at'],
+            'model': row['model'],
+            'api_provider': row['api_provider'],
+            'owner_id': row['owner_id']
+        })
         sessions[session.id] = session
     
     conn.close()
@@ -118,15 +147,16 @@ def save_session_to_db(session: ChatSession):
     # 插入或更新会话
     cursor.execute('''
         INSERT OR REPLACE INTO sessions 
-        (id, title, created_at, updated_at, model, api_provider)
-        VALUES (?, ?, ?, ?, ?, ?)
+        (id, title, created_at, updated_at, model, api_provider, owner_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
     ''', (
         session.id,
         session.title,
         session.created_at,
         session.updated_at,
         session.model,
-        session.api_provider
+        session.api_provider,
+        session.owner_id
     ))
     
     # 删除现有的消息
@@ -136,12 +166,13 @@ def save_session_to_db(session: ChatSession):
     for message in session.messages:
         cursor.execute('''
             INSERT INTO messages 
-            (session_id, role, content, timestamp)
-            VALUES (?, ?, ?, ?)
+            (session_id, role, content, file_urls, timestamp)
+            VALUES (?, ?, ?, ?, ?)
         ''', (
             session.id,
             message.role,
             message.content,
+            json.dumps(message.file_urls) if message.file_urls else None,
             message.timestamp
         ))
     
@@ -156,13 +187,16 @@ def delete_session_from_db(session_id: str) -> bool:
     cursor.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
     rows_affected = cursor.rowcount
     
+    # SQLite默认不启用外键约束，需要手动删除会话的消息
+    cursor.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+    
     conn.commit()
     conn.close()
     
     return rows_affected > 0
 
-def add_message_to_db(session_id: str, message: Message):
-    """向数据库中的会话添加消息"""
+def add_message_to_db(session_id: str, message: Message) -> int:
+    """向数据库中的会话添加消息，返回消息的数据库ID"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -180,6 +214,7 @@ def add_message_to_db(session_id: str, message: Message):
         file_urls_json,
         message.timestamp
     ))
+    message_id = cursor.lastrowid
     
     # 更新会话的updated_at时间
     cursor.execute('''
@@ -193,6 +228,8 @@ def add_message_to_db(session_id: str, message: Message):
     
     conn.commit()
     conn.close()
+    
+    return message_id
 
 def update_message_in_db(session_id: str, message_index: int, new_message: Message):
     """更新数据库中会话的特定消息"""
@@ -292,3 +329,54 @@ def update_session_in_db(session_id: str, title: str = None, model: str = None,
     
     conn.commit()
     conn.close()
+
+# 只转换ASCII大写字母，与SQLite的LIKE一致
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+def archive_contains(codec: str, payload: bytes, query: str) -> int:
+    """归档数据块中是否有消息内容包含query（与LIKE相同，ASCII字母不区分大小写）"""
+    # 延迟导入，archive模块依赖本模块
+    from .archive import decompress_payload
+    try:
+        messages = json.loads(decompress_payload(codec, payload))
+    except Exception as e:
+        print(f"解压归档数据失败: {e}")
+        return 0
+    # str.lower()会转换所有Unicode字母，LIKE只忽略ASCII字母的大小写
+    query = query.translate(ASCII_LOWER)
+    return int(any(query in message['content'].translate(ASCII_LOWER) for message in messages))
+
+def search_sessions_in_db(owner_id: str, query: str, limit: int = 50) -> List[str]:
+    """在用户自己的会话中按标题和消息内容搜索，返回按更新时间倒序的会话ID
+
+    已归档的会话解压后匹配，只在标题和热数据都不匹配时才解压。
+    """
+    conn = get_db_connection()
+    conn.create_function("archive_contains", 3, archive_contains, deterministic=True)
+    cursor = conn.cursor()
+    
+    # 转义LIKE通配符，按字面匹配用户输入
+    pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    
+    # 先用(owner_id, updated_at)索引限定到当前用户，再逐个检查消息
+    cursor.execute('''
+        SELECT s.id FROM sessions s
+        WHERE s.owner_id = ?
+          AND (
+            s.title LIKE ? ESCAPE '\\'
+            OR EXISTS (
+              SELECT 1 FROM messages m
+              WHERE m.session_id = s.id AND m.content LIKE ? ESCAPE '\\'
+            )
+            OR EXISTS (
+              SELECT 1 FROM archived_messages a
+              WHERE a.session_id = s.id AND archive_contains(a.codec, a.payload, ?)
+            )
+          )
+        ORDER BY s.updated_at DESC
+        LIMIT ?
+    ''', (owner_id, pattern, pattern, query, limit))
+    session_ids = [row['id'] for row in cursor.fetchall()]
+    
+    conn.close()
+    return session_ids
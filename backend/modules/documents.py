@@ -0,0 +1,352 @@
+import os
+import re
+import queue
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional
+from datetime import datetime
+from .database import DB_PATH, get_db_connection
+from .config import document_chunk_tokens
+
+# pypdf是可选依赖，未安装时不提取PDF内容
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# tiktoken是可选依赖，未安装时按字符估算token数
+try:
+    import tiktoken
+    token_encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    token_encoding = None
+
+# 按文本方式提取的文件扩展名
+TEXT_EXTENSIONS = {
+    '.txt', '.md', '.markdown', '.csv', '.tsv', '.json', '.jsonl', '.xml', '.yaml', '.yml',
+    '.ini', '.toml', '.log', '.html', '.htm', '.css', '.sql', '.sh', '.bat',
+    '.py', '.js', '.jsx', '.ts', '.tsx', '.java', '.c', '.h', '.cpp', '.hpp', '.cs',
+    '.go', '.rs', '.rb', '.php', '.swift', '.kt', '.scala', '.r', '.m', '.lua'
+}
+
+# 估算token数时按1个token计的中日韩字符
+CJK_PATTERN = re.compile('[⺀-鿿가-힯]')
+
+# 提取状态
+STATUS_PENDING = "pending"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+
+# 提取时每写入多少个块提交一次，避免长时间持有数据库写锁
+EXTRACT_COMMIT_CHUNKS = 32
+
+# 待提取的内容哈希队列
+extract_queue: "queue.Queue" = queue.Queue()
+
+def init_documents_db():
+    """创建上传文件和提取结果表"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    # 上传文件到内容哈希的映射，相同内容的文件共用一份提取结果
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uploaded_files (
+            file_url TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            original_name TEXT,
+            size INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_uploaded_files_content_hash
+        ON uploaded_files (content_hash)
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS document_extracts (
+            content_hash TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            chunk_count INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS document_chunks (
+            content_hash TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            token_count INTEGER NOT NULL,
+            PRIMARY KEY (content_hash, chunk_index)
+        )
+    ''')
+
+    conn.commit()
+    conn.close()
+
+def count_tokens(text: str) -> int:
+    """计算文本的token数，未安装tiktoken时估算"""
+    if token_encoding is not None:
+        return len(token_encoding.encode(text, disallowed_special=()))
+    # 中日韩字符约1个token，其他字符约4个字符1个token
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def register_upload(file_url: str, content_hash: str, original_name: str, size: int, file_path: str) -> Optional[str]:
+    """记录上传的文件，内容首次出现时加入提取队列，返回提取状态"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        INSERT OR REPLACE INTO uploaded_files
+        (file_url, content_hash, original_name, size, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (file_url, content_hash, original_name, size, datetime.now().isoformat()))
+
+    cursor.execute("SELECT status FROM document_extracts WHERE content_hash = ?", (content_hash,))
+    row = cursor.fetchone()
+    if row:
+        status = row['status']
+    else:
+        status = STATUS_PENDING
+        cursor.execute('''
+            INSERT INTO document_extracts (content_hash, status, updated_at)
+            VALUES (?, ?, ?)
+        ''', (content_hash, status, datetime.now().isoformat()))
+
+    conn.commit()
+    conn.close()
+
+    if not row:
+        extract_queue.put((content_hash, file_path, original_name))
+    return status
+
+def iter_text_file(file_path: str) -> Iterator[str]:
+    """逐行读取文本文件"""
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            yield line
+
+def iter_pdf_file(file_path: str) -> Iterator[str]:
+    """逐页提取PDF文本"""
+    if pypdf is None:
+        raise RuntimeError("未安装pypdf，无法提取PDF内容")
+    reader = pypdf.PdfReader(file_path)
+    for page in reader.pages:
+        yield (page.extract_text() or "") + "\n"
+
+def is_binary_file(file_path: str) -> bool:
+    """根据文件开头是否包含空字节判断是否为二进制文件"""
+    with open(file_path, "rb") as f:
+        return b"\x00" in f.read(8192)
+
+def iter_document(file_path: str, original_name: str) -> Iterator[str]:
+    """按文件类型选择提取方式，逐段产出文本"""
+    _, ext = os.path.splitext(original_name or file_path)
+    ext = ext.lower()
+    if ext == '.pdf':
+        return iter_pdf_file(file_path)
+    if ext in TEXT_EXTENSIONS or not is_binary_file(file_path):
+        return iter_text_file(file_path)
+    raise RuntimeError(f"不支持提取 {ext or '未知类型'} 文件的内容")
+
+def split_piece(piece: str, chunk_tokens: int) -> Iterator[tuple]:
+    """将超过chunk_tokens的单个片段按token数拆开，逐段产出(文本, token数)"""
+    start = 0
+    while start < len(piece):
+        # 先按每个token约4个字符取一段，超出时按比例缩短
+        size = min(len(piece) - start, chunk_tokens * 4)
+        tokens = count_tokens(piece[start:start + size])
+        while tokens > chunk_tokens and size > 1:
+            size = max(1, min(size - 1, size * chunk_tokens // tokens))
+            tokens = count_tokens(piece[start:start + size])
+        yield piece[start:start + size], tokens
+        start += size
+
+def iter_chunks(pieces: Iterator[str], chunk_tokens: int) -> Iterator[tuple]:
+    """将文本片段按行累积为不超过chunk_tokens的块，逐块产出(文本, token数)，整个过程只保留当前块
+
+    与提示词预算使用同一个count_tokens计数，中文文本的块大小同样接近chunk_tokens。
+    块的token数取各行之和，与整块计数相比略偏大，按预算截断时偏保守。
+    """
+    buffer = []
+    buffer_tokens = 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if tokens > chunk_tokens:
+            # 单行过长时强制拆分
+            if buffer:
+                yield "".join(buffer), buffer_tokens
+                buffer, buffer_tokens = [], 0
+            yield from split_piece(piece, chunk_tokens)
+            continue
+        if buffer_tokens + tokens > chunk_tokens and buffer:
+            yield "".join(buffer), buffer_tokens
+            buffer, buffer_tokens = [], 0
+        buffer.append(piece)
+        buffer_tokens += tokens
+    if buffer:
+        yield "".join(buffer), buffer_tokens
+
+def extract_document(content_hash: str, file_path: str, original_name: str):
+    """提取文档文本并分块写入数据库
+
+    每累积EXTRACT_COMMIT_CHUNKS个块写入并提交一次，只在写入时持有写锁，读取和解析文件期间
+    其他连接可以正常写入。提取完成前状态保持为pending，读取方不会用到写了一半的块。
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # 重新提取时清除上次中断留下的块
+    cursor.execute("DELETE FROM document_chunks WHERE content_hash = ?", (content_hash,))
+    conn.commit()
+
+    rows = []
+    chunk_count = 0
+    total_tokens = 0
+    try:
+        for text, token_count in iter_chunks(iter_document(file_path, original_name), document_chunk_tokens):
+            if not text.strip():
+                continue
+            rows.append((content_hash, chunk_count, text, token_count))
+            chunk_count += 1
+            total_tokens += token_count
+            if len(rows) >= EXTRACT_COMMIT_CHUNKS:
+                insert_chunks(conn, rows)
+                rows = []
+        insert_chunks(conn, rows)
+        status, error = STATUS_READY, None
+    except Exception as e:
+        conn.rollback()
+        cursor.execute("DELETE FROM document_chunks WHERE content_hash = ?", (content_hash,))
+        conn.commit()
+        chunk_count, total_tokens = 0, 0
+        status, error = STATUS_FAILED, str(e)
+
+    cursor.execute('''
+        UPDATE document_extracts
+        SET status = ?, chunk_count = ?, total_tokens = ?, error = ?, updated_at = ?
+        WHERE content_hash = ?
+    ''', (status, chunk_count, total_tokens, error, datetime.now().isoformat(), content_hash))
+
+    conn.commit()
+    conn.close()
+
+def insert_chunks(conn: sqlite3.Connection, rows: List[tuple]):
+    """在一个短事务中写入一批文档块"""
+    if not rows:
+        return
+    conn.executemany('''
+        INSERT INTO document_chunks (content_hash, chunk_index, text, token_count)
+        VALUES (?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+
+def extraction_worker():
+    """后台线程：逐个提取队列中的文档，每份内容只提取一次"""
+    while True:
+        content_hash, file_path, original_name = extract_queue.get()
+        try:
+            extract_document(content_hash, file_path, original_name)
+        except Exception as e:
+            print(f"提取文档 {original_name} 失败: {e}")
+
+def start_document_worker():
+    """启动提取线程，并重新排队上次未完成的提取"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT e.content_hash, MIN(f.file_url) AS file_url, MIN(f.original_name) AS original_name
+        FROM document_extracts e
+        JOIN uploaded_files f ON f.content_hash = e.content_hash
+        WHERE e.status = ?
+        GROUP BY e.content_hash
+    ''', (STATUS_PENDING,))
+    for row in cursor.fetchall():
+        extract_queue.put((row['content_hash'], row['file_url'].lstrip('/'), row['original_name']))
+    conn.close()
+
+    threading.Thread(target=extraction_worker, daemon=True).start()
+
+def get_file_documents(file_urls: List[str]) -> Dict[str, dict]:
+    """获取文件的原始名称和提取状态"""
+    if not file_urls:
+        return {}
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    placeholders = ",".join("?" for _ in file_urls)
+    cursor.execute(f'''
+        SELECT f.file_url, f.content_hash, f.original_name, e.status, e.total_tokens, e.error
+        FROM uploaded_files f
+        LEFT JOIN document_extracts e ON e.content_hash = f.content_hash
+        WHERE f.file_url IN ({placeholders})
+    ''', file_urls)
+    documents = {row['file_url']: dict(row) for row in cursor.fetchall()}
+    conn.close()
+    return documents
+
+def load_chunks_within_budget(content_hash: str, budget: int) -> tuple:
+    """按顺序读取文档块直到用完token预算，返回(文本, 使用的token数, 是否完整)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT text, token_count FROM document_chunks
+        WHERE content_hash = ?
+        ORDER BY chunk_index
+    ''', (content_hash,))
+
+    texts = []
+    used = 0
+    complete = True
+    for row in cursor:
+        if used + row['token_count'] > budget:
+            complete = False
+            break
+        texts.append(row['text'])
+        used += row['token_count']
+    conn.close()
+
+    return "".join(texts), used, complete
+
+def render_document(file_url: str, document: Optional[dict], budget: int) -> tuple:
+    """将文档渲染为可注入提示词的文本，返回(文本, 使用的token数, 结果是否已稳定)
+
+    提取尚未完成时结果会在之后变化，调用方不应缓存。
+    """
+    if document is None:
+        return f"[已上传文件]: {file_url}", 0, True
+
+    name = document['original_name'] or os.path.basename(file_url)
+    if document['status'] == STATUS_PENDING:
+        return f"[已上传文件 {name}]: 内容正在提取中", 0, False
+    if document['status'] == STATUS_FAILED:
+        return f"[已上传文件 {name}]: 无法提取内容", 0, True
+
+    text, used, complete = load_chunks_within_budget(document['content_hash'], max(budget, 0))
+    if not text:
+        return f"[已上传文件 {name}]: 内容超出上下文预算，未包含", 0, True
+    note = "" if complete else "\n[内容超出上下文预算，已截断]"
+    return f"[已上传文件 {name}]:\n{text}{note}", used, True
+
+def delete_file_records(file_urls: List[str]):
+    """删除文件记录，并清理不再被任何文件引用的提取结果"""
+    if not file_urls:
+        return
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany("DELETE FROM uploaded_files WHERE file_url = ?", [(url,) for url in file_urls])
+    cursor.execute('''
+        DELETE FROM document_chunks
+        WHERE content_hash NOT IN (SELECT content_hash FROM uploaded_files)
+    ''')
+    cursor.execute('''
+        DELETE FROM document_extracts
+        WHERE content_hash NOT IN (SELECT content_hash FROM uploaded_files)
+    ''')
+    conn.commit()
+    conn.close()
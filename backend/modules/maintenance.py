@@ -0,0 +1,45 @@
+import asyncio
+import time
+from .config import archive_idle_days, archive_interval_hours, upload_grace_hours, vacuum_interval_days, full_vacuum_enabled
+from .session_manager import find_idle_sessions, mark_session_archived
+from .archive import archive_session_in_db, collect_orphan_uploads, compact_db, get_maintenance_state, set_maintenance_state
+
+async def archive_idle_sessions() -> int:
+    """逐个归档空闲会话：压缩和数据库写入在线程中执行，内存中的状态回到事件循环中更新"""
+    archived = 0
+    for session, updated_at in find_idle_sessions(archive_idle_days):
+        await asyncio.to_thread(archive_session_in_db, session.id)
+        if mark_session_archived(session, updated_at):
+            archived += 1
+    return archived
+
+def full_vacuum_due() -> bool:
+    """距上次完整VACUUM超过配置的间隔时返回True；首次开启时只记录时间，不在启动时立即执行"""
+    if not full_vacuum_enabled:
+        return False
+    last = get_maintenance_state("last_full_vacuum")
+    if last is None:
+        set_maintenance_state("last_full_vacuum", str(time.time()))
+        return False
+    return time.time() - float(last) >= vacuum_interval_days * 86400
+
+async def run_maintenance():
+    """执行一轮归档、上传文件回收和数据库压缩，数据库和文件操作都不阻塞事件循环"""
+    archived = await archive_idle_sessions()
+    removed = await asyncio.to_thread(collect_orphan_uploads, upload_grace_hours)
+    
+    full = await asyncio.to_thread(full_vacuum_due)
+    await asyncio.to_thread(compact_db, full)
+    if full:
+        await asyncio.to_thread(set_maintenance_state, "last_full_vacuum", str(time.time()))
+    
+    print(f"维护完成: 归档 {archived} 个会话, 删除 {removed} 个上传文件, {'完整' if full else '增量'}压缩数据库")
+
+async def maintenance_loop():
+    """按配置的间隔周期性执行维护任务"""
+    while True:
+        try:
+            await run_maintenance()
+        except Exception as e:
+            print(f"维护任务失败: {e}")
+        await asyncio.sleep(archive_interval_hours * 3600)
@@ -0,0 +1,614 @@
+import os
+import json
+import time
+import queue
+import zlib
+import threading
+from typing import Dict, List, Optional
+from .database import DB_PATH, get_db_connection
+from .archive import decompress_payload
+from .config import (
+    get_registry, memory_enabled, memory_top_k, memory_min_score,
+    memory_embedding_provider, memory_embedding_model, memory_dimensions
+)
+
+# numpy是可选依赖，未安装时记忆功能不可用
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 索引文件前缀，与sessions.db放在同一目录
+INDEX_PREFIX = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "memory_index")
+
+# 单条消息参与嵌入的最大字符数
+MAX_EMBED_CHARS = 2000
+
+# 注入提示词时每个片段的最大字符数
+MAX_SNIPPET_CHARS = 500
+
+# 索引文件格式版本，变化时重建索引
+INDEX_VERSION = 2
+
+# 嵌入失败后重试的最长间隔（秒）
+MAX_RETRY_DELAY = 60
+
+class LocalEmbedder:
+    """离线可用的本地嵌入替身：字符n-gram特征哈希，结果确定且不需要网络"""
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self.name = f"local:{dimensions}"
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            text = text[:MAX_EMBED_CHARS].lower()
+            # 中文没有空格分词，使用字符一至三元组作为特征
+            for n in (1, 2, 3):
+                for i in range(len(text) - n + 1):
+                    h = zlib.crc32(text[i:i + n].encode("utf-8"))
+                    vectors[row, h % self.dimensions] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vectors)
+
+class ProviderEmbedder:
+    """通过已配置的提供商调用嵌入接口"""
+
+    def __init__(self, provider: str, model: str, dimensions: int):
+        self.provider = provider
+        self.model = model
+        self.dimensions = dimensions
+        self.name = f"{provider}:{model}:{dimensions}"
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        client = get_registry().get_client(self.provider)
+        if client is None:
+            raise RuntimeError(f"提供商 {self.provider} 的API密钥未配置")
+        response = client.embeddings.create(
+            model=self.model,
+            input=[text[:MAX_EMBED_CHARS] for text in texts]
+        )
+        vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+        if vectors.shape[1] != self.dimensions:
+            raise RuntimeError(f"嵌入维度 {vectors.shape[1]} 与配置的 {self.dimensions} 不一致")
+        return normalize(vectors)
+
+def normalize(vectors: "np.ndarray") -> "np.ndarray":
+    """L2归一化，使内积等于余弦相似度"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def content_hash(content: str) -> int:
+    """消息内容的哈希，用于判断向量对应的内容是否已变化"""
+    return zlib.crc32(content.encode("utf-8"))
+
+class VectorIndex:
+    """基于float32数组的暴力检索向量索引
+
+    每个向量以(会话, 消息在会话中的位置)为键，并记录内容哈希。归档和解压会改变消息在数据库中的行ID，
+    但不改变位置，因此不影响索引；消息被编辑或删除后由后台线程按哈希对齐，检索时内容已变化的向量被忽略。
+    各列分别追加写入二进制文件，新增向量时无需重写整个索引；删除以日志形式追加，失效的行过多时整体重写。
+    """
+
+    # 列名、文件后缀和类型
+    COLUMNS = (
+        ("session_codes", "sessions.i32", np.int32 if np is not None else None),
+        ("positions", "positions.i32", np.int32 if np is not None else None),
+        ("owner_codes", "owners.i32", np.int32 if np is not None else None),
+        ("hashes", "hashes.u32", np.uint32 if np is not None else None),
+    )
+
+    def __init__(self, prefix: str, dimensions: int, embedder_name: str):
+        self.prefix = prefix
+        self.dimensions = dimensions
+        self.embedder_name = embedder_name
+        self.size = 0
+        # 已失效的行数
+        self.dead = 0
+        self.vectors = np.empty((1024, dimensions), dtype=np.float32)
+        self.session_codes = np.empty(1024, dtype=np.int32)
+        self.positions = np.empty(1024, dtype=np.int32)
+        self.owner_codes = np.empty(1024, dtype=np.int32)
+        self.hashes = np.empty(1024, dtype=np.uint32)
+        self.alive = np.zeros(1024, dtype=bool)
+        # 用户ID和会话ID映射为整数编码，检索时按编码过滤
+        self.owners: List[str] = []
+        self.owner_lookup: Dict[str, int] = {}
+        self.session_ids: List[str] = []
+        self.session_lookup: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def path(self, suffix: str) -> str:
+        return f"{self.prefix}.{suffix}"
+
+    def load(self):
+        """从磁盘加载索引，嵌入方式或索引格式变化时丢弃旧索引"""
+        try:
+            with open(self.path("meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.reset()
+            return
+
+        if (meta.get("version") != INDEX_VERSION or meta.get("embedder") != self.embedder_name
+                or meta.get("dimensions") != self.dimensions):
+            print("嵌入方式或索引格式已变化，重建记忆索引")
+            self.reset()
+            return
+
+        try:
+            vectors = np.fromfile(self.path("vectors.f32"), dtype=np.float32)
+            columns = {name: np.fromfile(self.path(suffix), dtype=dtype) for name, suffix, dtype in self.COLUMNS}
+            with open(self.path("sessions.txt"), "r", encoding="utf-8") as f:
+                self.session_ids = f.read().splitlines()
+            drops = np.fromfile(self.path("drops.i64"), dtype=np.int64)
+        except FileNotFoundError:
+            self.reset()
+            return
+
+        # 写入过程中断时各文件长度可能不一致，以最短的为准
+        count = min([len(vectors) // self.dimensions] + [len(column) for column in columns.values()])
+        self.owners = meta.get("owners", [])
+        self.owner_lookup = {owner: code for code, owner in enumerate(self.owners)}
+        self.session_lookup = {session_id: code for code, session_id in enumerate(self.session_ids)}
+        self.reserve(count)
+        self.vectors[:count] = vectors[:count * self.dimensions].reshape(count, self.dimensions)
+        for name, _, _ in self.COLUMNS:
+            getattr(self, name)[:count] = columns[name][:count]
+        self.size = count
+        # 会话编码写入不完整的行无法使用
+        self.alive[:count] = self.session_codes[:count] < len(self.session_ids)
+        self.dead = count - int(np.count_nonzero(self.alive[:count]))
+
+        for session_code, position, limit in drops[:len(drops) // 3 * 3].reshape(-1, 3):
+            self.apply_drop(int(session_code), int(position), min(int(limit), count))
+
+        truncated = count * self.dimensions < len(vectors) or any(len(column) > count for column in columns.values())
+        if truncated or self.dead:
+            self.compact()
+
+    def reset(self):
+        """清空索引和磁盘文件"""
+        self.size = 0
+        self.dead = 0
+        self.owners = []
+        self.owner_lookup = {}
+        self.session_ids = []
+        self.session_lookup = {}
+        for suffix in ["vectors.f32", "sessions.txt", "drops.i64"] + [suffix for _, suffix, _ in self.COLUMNS]:
+            open(self.path(suffix), "wb").close()
+        self.save_meta()
+
+    def compact(self):
+        """丢弃失效的行并按内存中的数据重写磁盘文件
+
+        有效的行复制到新数组后整体替换，不原地移动，锁外仍持有旧数组切片的检索不受影响。
+        """
+        keep = np.flatnonzero(self.alive[:self.size])
+        count = len(keep)
+        capacity = len(self.alive)
+        vectors = np.empty((capacity, self.dimensions), dtype=np.float32)
+        vectors[:count] = self.vectors[keep]
+        self.vectors = vectors
+        for name, _, dtype in self.COLUMNS:
+            column = np.empty(capacity, dtype=dtype)
+            column[:count] = getattr(self, name)[keep]
+            setattr(self, name, column)
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:count] = True
+        self.alive = alive
+        self.size = count
+        self.dead = 0
+
+        self.vectors[:count].tofile(self.path("vectors.f32"))
+        for name, suffix, _ in self.COLUMNS:
+            getattr(self, name)[:count].tofile(self.path(suffix))
+        open(self.path("drops.i64"), "wb").close()
+
+    def save_meta(self):
+        """原子写入元数据"""
+        temp_path = self.path("meta.json.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "embedder": self.embedder_name,
+                "dimensions": self.dimensions,
+                "owners": self.owners
+            }, f)
+        os.replace(temp_path, self.path("meta.json"))
+
+    def reserve(self, capacity: int):
+        """按倍增策略扩容数组"""
+        if capacity <= len(self.alive):
+            return
+        new_capacity = max(capacity, len(self.alive) * 2)
+        vectors = np.empty((new_capacity, self.dimensions), dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        self.vectors = vectors
+        for name, _, dtype in self.COLUMNS:
+            column = np.empty(new_capacity, dtype=dtype)
+            column[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, column)
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[:self.size] = self.alive[:self.size]
+        self.alive = alive
+
+    def owner_code(self, owner_id: str) -> int:
+        """获取用户编码，新用户时分配编码并更新元数据"""
+        code = self.owner_lookup.get(owner_id)
+        if code is None:
+            code = len(self.owners)
+            self.owners.append(owner_id)
+            self.owner_lookup[owner_id] = code
+            self.save_meta()
+        return code
+
+    def session_code(self, session_id: str) -> int:
+        """获取会话编码，新会话时分配编码并追加写入"""
+        code = self.session_lookup.get(session_id)
+        if code is None:
+            code = len(self.session_ids)
+            self.session_ids.append(session_id)
+            self.session_lookup[session_id] = code
+            with open(self.path("sessions.txt"), "a", encoding="utf-8") as f:
+                f.write(session_id + "\n")
+        return code
+
+    def add(self, session_ids: List[str], positions: List[int], owner_ids: List[str],
+            hashes: List[int], vectors: "np.ndarray"):
+        """追加向量并追加写入磁盘"""
+        with self.lock:
+            count = len(session_ids)
+            columns = {
+                "session_codes": np.array([self.session_code(session_id) for session_id in session_ids], dtype=np.int32),
+                "positions": np.array(positions, dtype=np.int32),
+                "owner_codes": np.array([self.owner_code(owner_id or "") for owner_id in owner_ids], dtype=np.int32),
+                "hashes": np.array(hashes, dtype=np.uint32)
+            }
+            vectors = vectors.astype(np.float32, copy=False)
+
+            self.reserve(self.size + count)
+            self.vectors[self.size:self.size + count] = vectors
+            for name, values in columns.items():
+                getattr(self, name)[self.size:self.size + count] = values
+            self.alive[self.size:self.size + count] = True
+            self.size += count
+
+            with open(self.path("vectors.f32"), "ab") as f:
+                f.write(vectors.tobytes())
+            for name, suffix, _ in self.COLUMNS:
+                with open(self.path(suffix), "ab") as f:
+                    f.write(columns[name].tobytes())
+
+    def apply_drop(self, session_code: int, position: int, limit: int) -> int:
+        """使前limit行中属于该会话（position不小于0时只限该位置）的向量失效，返回失效的行数"""
+        mask = self.alive[:limit] & (self.session_codes[:limit] == session_code)
+        if position >= 0:
+            mask &= self.positions[:limit] == position
+        dropped = int(np.count_nonzero(mask))
+        if dropped:
+            self.alive[:limit][mask] = False
+            self.dead += dropped
+        return dropped
+
+    def drop(self, session_id: str, positions: Optional[List[int]] = None, limit: Optional[int] = None):
+        """使会话的向量失效，positions为None时整个会话失效；只影响前limit行，之后新加入的向量保留"""
+        with self.lock:
+            code = self.session_lookup.get(session_id)
+            if code is None:
+                return
+            limit = self.size if limit is None else min(limit, self.size)
+            log = [
+                (code, position, limit)
+                for position in (positions if positions is not None else [-1])
+                if self.apply_drop(code, position, limit)
+            ]
+            if log:
+                with open(self.path("drops.i64"), "ab") as f:
+                    f.write(np.array(log, dtype=np.int64).tobytes())
+            if self.dead > max(1024, self.size // 4):
+                self.compact()
+
+    def session_rows(self, session_id: str) -> List[tuple]:
+        """会话中有效的向量，返回(行号, 位置, 内容哈希)列表"""
+        with self.lock:
+            code = self.session_lookup.get(session_id)
+            if code is None:
+                return []
+            rows = np.flatnonzero(self.alive[:self.size] & (self.session_codes[:self.size] == code))
+            return [(int(row), int(self.positions[row]), int(self.hashes[row])) for row in rows]
+
+    def session_counts(self) -> Dict[str, int]:
+        """每个会话的有效向量数"""
+        with self.lock:
+            counts = np.bincount(self.session_codes[:self.size][self.alive[:self.size]],
+                                 minlength=len(self.session_ids))
+            return {session_id: int(count) for session_id, count in zip(self.session_ids, counts) if count}
+
+    def search(self, owner_id: str, query: "np.ndarray", k: int) -> List[tuple]:
+        """在用户自己的向量中检索最相似的k个，返回(会话ID, 位置, 内容哈希, 相似度)列表"""
+        with self.lock:
+            code = self.owner_lookup.get(owner_id or "")
+            # 扩容和compact会替换整个数组，新增向量只写入size之后的位置，已有的行不会原地修改，
+            # 持有切片即可在锁外计算
+            vectors = self.vectors[:self.size]
+            session_codes = self.session_codes[:self.size]
+            positions = self.positions[:self.size]
+            hashes = self.hashes[:self.size]
+            rows = np.flatnonzero(self.alive[:self.size] & (self.owner_codes[:self.size] == code)) if code is not None else []
+            session_ids = self.session_ids
+
+        # 先按用户筛出行号，只对该用户的向量计算相似度；该用户占索引的大部分时，
+        # 复制其向量的开销超过计算本身，改为对整个索引计算后再按行号取出
+        if len(rows) == 0:
+            return []
+        if len(rows) * 4 > len(vectors):
+            scores = (vectors @ query)[rows]
+        else:
+            scores = vectors[rows] @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (session_ids[session_codes[rows[i]]], int(positions[rows[i]]), int(hashes[rows[i]]), float(scores[i]))
+            for i in top
+        ]
+
+# 全局嵌入器、索引和待处理队列
+embedder = None
+index: Optional[VectorIndex] = None
+# 队列元素：("message", 会话ID, 位置, 用户ID, 内容)、("sync", 会话ID) 或 ("delete", 会话ID)
+embed_queue: "queue.Queue" = queue.Queue()
+
+def create_embedder():
+    """根据配置创建嵌入器"""
+    if memory_embedding_provider == "local":
+        return LocalEmbedder(memory_dimensions)
+    return ProviderEmbedder(memory_embedding_provider, memory_embedding_model, memory_dimensions)
+
+def is_memory_active() -> bool:
+    """记忆功能是否已启用并完成初始化"""
+    return index is not None
+
+def start_memory():
+    """加载索引并启动后台嵌入线程"""
+    global embedder, index
+
+    if not memory_enabled:
+        return
+    if np is None:
+        print("未安装numpy，记忆功能不可用")
+        return
+
+    embedder = create_embedder()
+    index = VectorIndex(INDEX_PREFIX, memory_dimensions, embedder.name)
+    index.load()
+
+    threading.Thread(target=embedding_worker, daemon=True).start()
+
+def enqueue_message(session_id: str, position: int, owner_id: str, content: str):
+    """将新消息加入嵌入队列，由后台线程异步处理"""
+    if index is not None and content.strip():
+        embed_queue.put(("message", session_id, position, owner_id, content))
+
+def sync_session_memory(session_id: str):
+    """会话的消息被编辑、删除或整体写入后，由后台线程按数据库中的内容对齐索引"""
+    if index is not None:
+        embed_queue.put(("sync", session_id))
+
+def forget_session_memory(session_id: str):
+    """会话删除后使其向量失效"""
+    if index is not None:
+        embed_queue.put(("delete", session_id))
+
+def load_session_messages(conn, session_id: str) -> tuple:
+    """读取会话的(所属用户ID, 消息列表)，归档会话解压后读取；会话不存在时返回(None, None)"""
+    # 在同一个读事务中读取，避免恰好遇到归档或解压时看到消息不在任何一张表中
+    conn.execute("BEGIN")
+    try:
+        row = conn.execute("SELECT owner_id FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None, None
+        archived = conn.execute(
+            "SELECT codec, payload FROM archived_messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if archived:
+            messages = json.loads(decompress_payload(archived['codec'], archived['payload']))
+        else:
+            messages = [
+                {"role": message['role'], "content": message['content']}
+                for message in conn.execute(
+                    "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id", (session_id,)
+                )
+            ]
+        return row['owner_id'], messages
+    finally:
+        conn.rollback()
+
+def embed_messages(session_ids: List[str], positions: List[int], owner_ids: List[str], contents: List[str]):
+    vectors = embedder.embed(contents)
+    index.add(session_ids, positions, owner_ids, [content_hash(content) for content in contents], vectors)
+
+def sync_session(conn, session_id: str, batch_size: int = 64):
+    """按当前内容对齐会话的向量：内容未变的保留，位置变化但内容相同的复用向量，其余重新嵌入"""
+    owner_id, messages = load_session_messages(conn, session_id)
+    if messages is None:
+        index.drop(session_id)
+        return
+
+    rows = index.session_rows(session_id)
+    limit = index.size
+    indexed = {position: content_hash for _, position, content_hash in rows}
+    rows_by_hash = {content_hash: row for row, _, content_hash in rows}
+
+    current = {
+        position: content_hash(message['content'])
+        for position, message in enumerate(messages)
+        if message['content'].strip()
+    }
+    stale = [position for position, value in indexed.items() if current.get(position) != value]
+    missing = [position for position, value in current.items() if indexed.get(position) != value]
+
+    # 删除消息后后续消息的位置前移，内容不变，直接复用已有的向量
+    reused = [position for position in missing if current[position] in rows_by_hash]
+    if reused:
+        with index.lock:
+            vectors = index.vectors[[rows_by_hash[current[position]] for position in reused]]
+        index.add([session_id] * len(reused), reused, [owner_id] * len(reused),
+                  [current[position] for position in reused], vectors)
+
+    to_embed = [position for position in missing if current[position] not in rows_by_hash]
+    for offset in range(0, len(to_embed), batch_size):
+        batch = to_embed[offset:offset + batch_size]
+        embed_messages([session_id] * len(batch), batch, [owner_id] * len(batch),
+                       [messages[position]['content'] for position in batch])
+
+    # 新加入的向量在limit之后，不受影响
+    if stale:
+        index.drop(session_id, stale, limit)
+
+def backfill_index():
+    """对齐消息数与索引不一致的会话，用于首次启用、重启前未处理完的队列或导入的会话"""
+    conn = get_db_connection()
+    counts = index.session_counts()
+
+    message_counts = {}
+    for row in conn.execute("SELECT session_id, COUNT(*) AS count FROM messages GROUP BY session_id"):
+        message_counts[row['session_id']] = row['count']
+    for row in conn.execute("SELECT session_id, message_count FROM archived_messages"):
+        message_counts[row['session_id']] = row['message_count']
+    session_ids = {row['id'] for row in conn.execute("SELECT id FROM sessions")}
+
+    for session_id in counts.keys() - session_ids:
+        index.drop(session_id)
+    for session_id in session_ids:
+        if counts.get(session_id, 0) != message_counts.get(session_id, 0):
+            sync_session(conn, session_id)
+
+    conn.close()
+
+def process_items(conn, items: List[tuple]):
+    """按顺序处理一批队列元素，相邻的新消息合并为一次嵌入调用"""
+    pending = []
+
+    def flush():
+        if not pending:
+            return
+        limit = index.size
+        indexed = {}
+        for session_id in {item[0] for item in pending}:
+            indexed[session_id] = {position: value for _, position, value in index.session_rows(session_id)}
+        # 重试时已写入的消息跳过；同一位置上的旧内容（如删除消息后追加的新消息）在写入后失效
+        items = [item for item in pending if indexed[item[0]].get(item[1]) != content_hash(item[3])]
+        if items:
+            embed_messages(*(list(column) for column in zip(*items)))
+        for session_id, position, _, _ in items:
+            if position in indexed[session_id]:
+                index.drop(session_id, [position], limit)
+        pending.clear()
+
+    for item in items:
+        if item[0] == "message":
+            pending.append(item[1:])
+            continue
+        flush()
+        if item[0] == "sync":
+            sync_session(conn, item[1])
+        elif item[0] == "delete":
+            index.drop(item[1])
+    flush()
+
+def embedding_worker(batch_size: int = 64):
+    """后台线程：批量取出队列中的元素并更新索引，失败时退避后重试同一批"""
+    conn = get_db_connection()
+    # 读取消息时手动开启事务
+    conn.isolation_level = None
+
+    try:
+        backfill_index()
+    except Exception as e:
+        print(f"补齐记忆索引失败: {e}")
+
+    while True:
+        batch = [embed_queue.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(embed_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        delay = 1.0
+        while True:
+            try:
+                process_items(conn, batch)
+                break
+            except Exception as e:
+                # 提供商暂时不可用时不丢弃消息，重试时已写入的部分会被跳过
+                print(f"更新记忆索引失败，{delay:.0f} 秒后重试: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+def load_snippet(conn, session_id: str, position: int, archived_cache: Dict[str, Optional[list]]) -> Optional[dict]:
+    """读取会话中指定位置的消息，归档会话在一次检索中只解压一次"""
+    if session_id not in archived_cache:
+        row = conn.execute(
+            "SELECT codec, payload FROM archived_messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        archived_cache[session_id] = json.loads(decompress_payload(row['codec'], row['payload'])) if row else None
+
+    messages = archived_cache[session_id]
+    if messages is not None:
+        return messages[position] if position < len(messages) else None
+    row = conn.execute('''
+        SELECT role, content FROM messages
+        WHERE session_id = ?
+        ORDER BY id
+        LIMIT 1 OFFSET ?
+    ''', (session_id, position)).fetchone()
+    return {"role": row['role'], "content": row['content']} if row else None
+
+def retrieve_memories(owner_id: str, query: str, exclude_session_id: str = None, top_k: int = None) -> List[dict]:
+    """检索与查询相关的历史消息片段（包括已归档的会话），排除当前会话"""
+    if index is None or not query.strip():
+        return []
+    top_k = top_k or memory_top_k
+
+    query_vector = embedder.embed([query])[0]
+    # 多取一些候选，过滤掉当前会话和内容已变化的消息后再截断
+    candidates = [candidate for candidate in index.search(owner_id, query_vector, top_k * 4)
+                  if candidate[3] >= memory_min_score and candidate[0] != exclude_session_id]
+    if not candidates:
+        return []
+
+    conn = get_db_connection()
+    titles = {}
+    archived_cache = {}
+    memories = []
+    for session_id, position, value, score in candidates:
+        if session_id not in titles:
+            row = conn.execute("SELECT title, owner_id FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            titles[session_id] = row['title'] if row and row['owner_id'] == owner_id else None
+        if titles[session_id] is None:
+            continue
+        message = load_snippet(conn, session_id, position, archived_cache)
+        if message is None or content_hash(message['content']) != value:
+            continue
+        memories.append({
+            "session_title": titles[session_id],
+            "role": message['role'],
+            "content": message['content'][:MAX_SNIPPET_CHARS],
+            "score": round(score, 4)
+        })
+        if len(memories) >= top_k:
+            break
+    conn.close()
+    return memories
+
+def build_memory_message(memories: List[dict]) -> dict:
+    """将检索到的片段组装为系统消息"""
+    lines = ["以下是与当前问题可能相关的历史对话片段，仅供参考："]
+    for memory in memories:
+        speaker = "用户" if memory["role"] == "user" else "助手"
+        lines.append(f"[{memory['session_title']}] {speaker}: {memory['content']}")
+    return {"role": "system", "content": "\n".join(lines)}
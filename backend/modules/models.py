@@ -1,7 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
-from .config import default_model, default_provider
+from .config import get_registry
 
 class Message(BaseModel):
     role: str  # "user" or "assistant"
@@ -15,8 +15,12 @@ class ChatSession(BaseModel):
     messages: List[Message]
     created_at: str
     updated_at: str
-    model: str = default_model
-    api_provider: str = default_provider
+    # 默认值在创建时从当前注册表读取，以便配置热重载后生效
+    model: str = Field(default_factory=lambda: get_registry().default_model)
+    api_provider: str = Field(default_factory=lambda: get_registry().default_provider)
+    archived: bool = False  # 消息已压缩移入归档表
+    unloaded: bool = Field(default=False, exclude=True)  # 消息在消息表中、尚未加载到内存（导入的会话），不对外返回
+    owner_id: Optional[str] = None  # 所属用户ID
 
 class ChatConfig(BaseModel):
     api_key: str
@@ -33,3 +37,21 @@ class ChatRequest(BaseModel):
     message: str
     session_id: str
     file_urls: Optional[List[str]] = None
+
+class User(BaseModel):
+    id: str
+    username: str
+    is_admin: bool = False
+    session_quota: int = 0  # 最多可创建的会话数，0表示不限制
+    daily_message_quota: int = 0  # 每天最多可发送的聊天消息数，0表示不限制
+
+class LoginRequest(BaseModel):
+    username: str
+    password: str
+
+class UserCreate(BaseModel):
+    username: str
+    password: str
+    is_admin: bool = False
+    session_quota: Optional[int] = None
+    daily_message_quota: Optional[int] = None
@@ -1,39 +1,68 @@
 from fastapi import HTTPException
-from typing import List, Dict, Union
-from .config import openai_clients, default_client, provider_parameters
-
-async def call_openai_api(messages: List[Dict[str, Union[str, List[Dict]]]], model: str, provider: str = None) -> str:
-    """调用OpenAI API"""
-    client = None
-    selected_provider = None
-    
-    # 如果指定了提供商，使用对应的客户端
-    if provider and provider in openai_clients:
-        client = openai_clients[provider]
-        selected_provider = provider
-    # 否则使用默认客户端
-    elif default_client:
-        client = default_client
-        selected_provider = [name for name, c in openai_clients.items() if c == default_client][0] if default_client in openai_clients.values() else None
-    else:
-        raise HTTPException(status_code=500, detail="API密钥未配置")
-    
-    # 获取提供商参数，默认参数
+from typing import AsyncIterator, List, Dict, Optional, Tuple, Union
+from .config import get_registry
+
+def select_provider(registry, provider: str = None) -> str:
+    """如果指定了提供商，使用对应的客户端，否则使用默认提供商"""
+    if provider and registry.has_client(provider):
+        return provider
+    return registry.default_provider
+
+def provider_params(registry, provider: str) -> dict:
+    """获取提供商参数，未配置时使用默认参数"""
     params = {
         "temperature": 0.7,
         "max_tokens": 1000
     }
-    
-    if selected_provider and selected_provider in provider_parameters:
-        params.update(provider_parameters[selected_provider])
-    
+
+    if provider in registry.provider_parameters:
+        params.update(registry.provider_parameters[provider])
+    return params
+
+async def stream_openai_api(messages: List[Dict[str, Union[str, List[Dict]]]], model: str, provider: str = None) -> AsyncIterator[Tuple[str, Optional[Dict]]]:
+    """以流式方式调用OpenAI API，逐段产出(增量文本, 用量)，用量只在最后一段中出现
+
+    调用方停止迭代或任务被取消时关闭上游连接，提供商随即停止生成。
+    """
+    registry = get_registry()
+    selected_provider = select_provider(registry, provider)
+
+    client = registry.get_async_client(selected_provider)
+    if client is None:
+        raise HTTPException(status_code=500, detail="API密钥未配置")
+
+    params = provider_params(registry, selected_provider)
+    request = {
+        "model": model,
+        "messages": messages,
+        "temperature": params["temperature"],
+        "max_tokens": params["max_tokens"],
+        "stream": True
+    }
+    stream_usage = registry.stream_usage.get(selected_provider, False)
+
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=params["temperature"],
-            max_tokens=params["max_tokens"]
-        )
-        return response.choices[0].message.content
+        try:
+            # 支持时要求提供商在最后一段中返回用量
+            stream = await client.chat.completions.create(
+                **request,
+                **({"extra_body": {"stream_options": {"include_usage": True}}} if stream_usage else {})
+            )
+        except Exception as e:
+            if not stream_usage or getattr(e, "status_code", None) != 400:
+                raise
+            # 可能是提供商不接受stream_options，不附带重试一次；成功则之后不再附带
+            stream = await client.chat.completions.create(**request)
+            print(f"提供商 {selected_provider} 拒绝了stream_options，之后不再请求用量: {e}")
+            registry.stream_usage[selected_provider] = False
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"API调用失败: {str(e)}")
+
+    try:
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            usage = getattr(chunk, "usage", None)
+            if delta or usage is not None:
+                yield delta or "", usage
+    finally:
+        await stream.response.aclose()
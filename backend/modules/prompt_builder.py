@@ -0,0 +1,176 @@
+import os
+import base64
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from .models import ChatSession, Message
+from .config import document_context_budget, document_turn_budget
+from .documents import get_file_documents, render_document
+
+# 图片扩展名到MIME类型的映射，按扩展名确定，保证每轮生成的字节一致
+IMAGE_MIME_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp'
+}
+
+# 最多为多少个会话缓存已渲染的消息
+MAX_CACHED_SESSIONS = 256
+
+def encode_image_to_base64(image_path: str) -> str:
+    """将图片文件编码为base64字符串"""
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
+
+def is_image_file(file_path: str) -> bool:
+    """检查文件是否为图片"""
+    _, ext = os.path.splitext(file_path)
+    return ext.lower() in IMAGE_MIME_TYPES
+
+class PromptEntry:
+    """一条已渲染的消息及其渲染时的状态"""
+
+    __slots__ = ("fingerprint", "rendered", "budget_used", "stable")
+
+    def __init__(self, fingerprint: tuple, rendered: dict, budget_used: int, stable: bool):
+        self.fingerprint = fingerprint
+        self.rendered = rendered
+        self.budget_used = budget_used  # 截至本条消息累计使用的文档预算
+        self.stable = stable  # 渲染结果是否会在之后变化（例如文档仍在提取中）
+
+# 会话ID -> 已渲染的消息列表，按最近使用排序
+prompt_cache: "OrderedDict[str, List[PromptEntry]]" = OrderedDict()
+
+# 提供商返回的缓存命中统计
+cache_stats = {
+    "requests": 0,
+    "prompt_tokens": 0,
+    "cached_tokens": 0,
+    "reused_messages": 0,
+    "rendered_messages": 0
+}
+
+def message_fingerprint(message: Message) -> tuple:
+    """决定消息渲染结果的字段"""
+    return (message.role, message.content, tuple(message.file_urls or ()))
+
+def render_message(message: Message, documents: Dict[str, dict], budget: int) -> tuple:
+    """渲染单条消息，返回(消息字典, 使用的文档预算, 是否稳定)"""
+    if not message.file_urls:
+        # 没有文件的普通消息
+        return {"role": message.role, "content": message.content}, 0, True
+
+    # 创建包含文本和图片的内容数组，文本部分最后一次性生成
+    texts = [message.content]
+    images = []
+    used = 0
+    stable = True
+
+    # 处理每个上传的文件
+    for file_url in message.file_urls:
+        # 转换URL为本地文件路径
+        file_path = file_url.lstrip('/')
+        _, ext = os.path.splitext(file_path)
+
+        # 检查文件是否存在且是图片
+        if is_image_file(file_path) and os.path.exists(file_path):
+            try:
+                images.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{IMAGE_MIME_TYPES[ext.lower()]};base64,{encode_image_to_base64(file_path)}"
+                    }
+                })
+            except OSError:
+                # 错误信息可能每次不同，只记录固定的说明
+                texts.append(f"\n[图片处理失败]: {file_url}")
+        elif is_image_file(file_path):
+            texts.append(f"\n\n[已上传文件]: {file_url}")
+        else:
+            # 对于文档，添加缓存的文本块
+            text, document_used, document_stable = render_document(file_url, documents.get(file_url), budget - used)
+            texts.append(f"\n\n{text}")
+            used += document_used
+            stable = stable and document_stable
+
+    content_parts = [{"type": "text", "text": "".join(texts)}] + images
+    return {"role": message.role, "content": content_parts}, used, stable
+
+def build_prompt_messages(session: ChatSession) -> List[dict]:
+    """构建会话的消息历史，复用上一轮已渲染的前缀，只渲染新增或变化的消息
+
+    文档预算按消息顺序从旧到新分配，新的轮次不会改变之前消息的渲染结果，
+    因此发给提供商的前缀在各轮之间逐字节一致，可以命中提供商的提示词缓存。
+    每条消息至少可以使用document_turn_budget，共享预算被之前的附件用完后，
+    新上传的文档仍会附带给模型，代价是文档的总token数可能超过context_token_budget。
+    """
+    entries = prompt_cache.pop(session.id, [])
+
+    # 找出可以复用的最长前缀，遇到不稳定或已变化的消息即停止
+    reused = 0
+    for entry, message in zip(entries, session.messages):
+        if not entry.stable or entry.fingerprint != message_fingerprint(message):
+            break
+        reused += 1
+    entries = entries[:reused]
+
+    pending = session.messages[reused:]
+    document_urls = [
+        file_url
+        for message in pending if message.file_urls
+        for file_url in message.file_urls if not is_image_file(file_url)
+    ]
+    documents = get_file_documents(document_urls) if document_urls else {}
+
+    budget_used = entries[-1].budget_used if entries else 0
+    for message in pending:
+        budget = max(document_context_budget - budget_used, document_turn_budget)
+        rendered, used, stable = render_message(message, documents, budget)
+        budget_used += used
+        entries.append(PromptEntry(message_fingerprint(message), rendered, budget_used, stable))
+
+    prompt_cache[session.id] = entries
+    while len(prompt_cache) > MAX_CACHED_SESSIONS:
+        prompt_cache.popitem(last=False)
+
+    cache_stats["reused_messages"] += reused
+    cache_stats["rendered_messages"] += len(pending)
+    return [entry.rendered for entry in entries]
+
+def forget_session_prompt(session_id: str):
+    """丢弃会话的渲染缓存"""
+    prompt_cache.pop(session_id, None)
+
+def extract_cached_tokens(usage) -> Optional[int]:
+    """从提供商返回的用量中读取命中缓存的token数，兼容不同提供商的字段"""
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else dict(usage)
+
+    details = usage.get("prompt_tokens_details") or {}
+    if details.get("cached_tokens") is not None:
+        return details["cached_tokens"]
+    # DeepSeek等提供商使用的字段
+    if usage.get("prompt_cache_hit_tokens") is not None:
+        return usage["prompt_cache_hit_tokens"]
+    return None
+
+def record_usage(usage) -> dict:
+    """记录一次调用的用量并返回摘要"""
+    if usage is None:
+        return {}
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else dict(usage)
+
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    cached_tokens = extract_cached_tokens(usage) or 0
+    cache_stats["requests"] += 1
+    cache_stats["prompt_tokens"] += prompt_tokens
+    cache_stats["cached_tokens"] += cached_tokens
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": usage.get("completion_tokens") or 0,
+        "cached_tokens": cached_tokens
+    }
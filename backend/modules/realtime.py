@@ -0,0 +1,301 @@
+import json
+import asyncio
+from typing import Dict, Optional, Set
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException
+from .models import ChatSession, User
+from .config import auth_enabled, websocket_send_queue_size, websocket_auth_timeout_seconds
+from .chat import prepare_chat_turn, generate_reply, Generation
+from .prompt_builder import record_usage
+from .serialization import dumps, message_to_dict, session_summary_to_dict
+from .startup import wait_until_ready
+from . import auth
+
+# WebSocket关闭码
+CLOSE_POLICY_VIOLATION = 1008  # 认证失败或协议错误
+CLOSE_TRY_AGAIN = 1013  # 服务未就绪或客户端接收过慢
+
+class Connection:
+    """一个已认证的WebSocket连接
+
+    所有发往客户端的帧先进入有界队列，由单独的任务按顺序发送。客户端接收过慢时：
+    流式增量在队列过半后合并为更大的帧，不再占用新的队列位置；
+    会话变更通知按会话合并，同一会话只保留最新的一条；
+    其他帧在队列已满时直接关闭连接，由客户端重连后重新拉取。
+    因此每个连接占用的内存有上限，不会被慢客户端拖垮。
+    """
+
+    def __init__(self, websocket: WebSocket, user: User):
+        self.websocket = websocket
+        self.user = user
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=websocket_send_queue_size)
+        # 流式增量最多占用一半队列，剩余位置留给结束帧和其他帧
+        self.token_limit = max(websocket_send_queue_size // 2, 1)
+        # 待发送的会话变更通知：会话ID -> 帧
+        self.notifications: Dict[str, str] = {}
+        self.wakeup = asyncio.Event()
+        # 进行中的聊天轮次：客户端请求ID -> 任务
+        self.turns: Dict[str, asyncio.Task] = {}
+        # 已开始生成的轮次：客户端请求ID -> 生成
+        self.generations: Dict[str, Generation] = {}
+        self.closed = False
+        self.sender = asyncio.create_task(self.send_loop())
+
+    async def send_loop(self):
+        """按顺序发送队列中的帧，队列为空时发送积压的通知"""
+        try:
+            while True:
+                if self.queue.empty() and not self.notifications:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                if not self.queue.empty():
+                    text = self.queue.get_nowait()
+                else:
+                    text = self.notifications.pop(next(iter(self.notifications)))
+                await self.websocket.send_text(text)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 连接已断开，接收循环会随之结束
+            self.closed = True
+
+    def push(self, frame: dict) -> bool:
+        """不等待地发送一帧，队列已满时关闭连接"""
+        return self.push_text(dumps(frame).decode("utf-8"))
+
+    def push_text(self, text: str) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.abort()
+            return False
+        self.wakeup.set()
+        return True
+
+    async def send(self, frame: dict):
+        """发送一帧，队列已满时等待"""
+        if not self.closed:
+            await self.queue.put(dumps(frame).decode("utf-8"))
+            self.wakeup.set()
+
+    def notify(self, session_id: str, text: str):
+        """加入会话变更通知，覆盖同一会话尚未发出的通知"""
+        if not self.closed:
+            self.notifications.pop(session_id, None)
+            self.notifications[session_id] = text
+            self.wakeup.set()
+
+    def can_stream(self) -> bool:
+        """队列未过半时才单独发送流式增量"""
+        return self.queue.qsize() < self.token_limit
+
+    def abort(self):
+        """客户端接收过慢，关闭连接"""
+        if self.closed:
+            return
+        self.closed = True
+        self.sender.cancel()
+        asyncio.create_task(self.close(CLOSE_TRY_AGAIN))
+
+    async def close(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def shutdown(self):
+        """连接结束时取消进行中的轮次并停止发送，已生成的部分作为被中断的回复记录"""
+        self.closed = True
+        for task in list(self.turns.values()):
+            task.cancel()
+        self.sender.cancel()
+
+# 在线连接：用户ID -> 连接集合
+connections: Dict[str, Set[Connection]] = {}
+
+def register_connection(connection: Connection):
+    connections.setdefault(connection.user.id, set()).add(connection)
+
+def unregister_connection(connection: Connection):
+    user_connections = connections.get(connection.user.id)
+    if user_connections is not None:
+        user_connections.discard(connection)
+        if not user_connections:
+            del connections[connection.user.id]
+
+def notify_session_change(owner_id: str, event: str, session: ChatSession = None,
+                          session_id: str = None, exclude: Optional[Connection] = None):
+    """向用户的所有连接推送会话变更（created/updated/deleted），只包含会话元数据"""
+    user_connections = connections.get(owner_id)
+    if not user_connections:
+        return
+
+    frame = {"type": "session", "event": event}
+    if session is not None:
+        frame["session"] = session_summary_to_dict(session)
+        session_id = session.id
+    else:
+        frame["session_id"] = session_id
+    # 只序列化一次，所有连接共用
+    text = dumps(frame).decode("utf-8")
+    for connection in list(user_connections):
+        if connection is not exclude:
+            connection.notify(session_id, text)
+
+async def authenticate(websocket: WebSocket) -> Optional[User]:
+    """读取第一帧中的令牌；浏览器无法为WebSocket设置请求头，因此令牌不放在URL中而是作为首帧发送"""
+    if not auth_enabled:
+        return auth.get_user(auth.admin_user_id)
+
+    try:
+        frame = json.loads(await asyncio.wait_for(websocket.receive_text(), timeout=websocket_auth_timeout_seconds))
+    except (asyncio.TimeoutError, ValueError, KeyError):
+        # 超时、非JSON或二进制帧
+        return None
+    if not isinstance(frame, dict) or frame.get("type") != "auth" or not frame.get("token"):
+        return None
+    return auth.resolve_token(str(frame["token"]))
+
+async def run_chat_turn(connection: Connection, request_id: str, frame: dict):
+    """执行一轮聊天，将模型输出以增量帧流式推送给客户端"""
+    session_id = frame.get("session_id")
+    try:
+        session, messages = await prepare_chat_turn(
+            connection.user, session_id, frame.get("message", ""), frame.get("file_urls") or None
+        )
+    except HTTPException as e:
+        await connection.send({"type": "error", "request_id": request_id, "status": e.status_code, "detail": e.detail})
+        return
+    except Exception as e:
+        # 其他异常也要回复客户端，否则这一轮会一直等待
+        print(f"准备聊天失败: {e}")
+        await connection.send({"type": "error", "request_id": request_id, "status": 500, "detail": "服务器内部错误"})
+        return
+
+    pending = []
+
+    def on_delta(delta: str):
+        pending.append(delta)
+        # 客户端跟不上时合并增量，既不阻塞上游也不让队列增长
+        if connection.can_stream():
+            connection.push({"type": "token", "request_id": request_id, "delta": "".join(pending)})
+            pending.clear()
+
+    generation = Generation(session_id)
+    connection.generations[request_id] = generation
+    try:
+        session, assistant_message, usage, cancelled = await generate_reply(generation, session, messages, on_delta=on_delta)
+    except HTTPException as e:
+        # 错误已记录为助手消息
+        notify_session_change(connection.user.id, "updated", session)
+        await connection.send({"type": "error", "request_id": request_id, "status": e.status_code, "detail": e.detail})
+        return
+    except Exception as e:
+        print(f"生成回复失败: {e}")
+        await connection.send({"type": "error", "request_id": request_id, "status": 500, "detail": "服务器内部错误"})
+        return
+    finally:
+        connection.generations.pop(request_id, None)
+
+    if pending:
+        await connection.send({"type": "token", "request_id": request_id, "delta": "".join(pending)})
+
+    if not session:
+        # 生成期间会话已被删除
+        await connection.send({"type": "error", "request_id": request_id, "status": 404, "detail": "会话未找到"})
+        return
+    await connection.send({
+        # 被中断时同样返回已记录的部分回复
+        "type": "cancelled" if cancelled else "done",
+        "request_id": request_id,
+        "session": session_summary_to_dict(session),
+        "response": message_to_dict(assistant_message),
+        "usage": record_usage(usage)
+    })
+    notify_session_change(connection.user.id, "updated", session, exclude=connection)
+
+def start_chat_turn(connection: Connection, frame: dict):
+    """在后台任务中执行聊天，同一连接上可以同时进行多轮"""
+    request_id = frame.get("request_id")
+    session_id = frame.get("session_id")
+    # request_id用作字典键，不是字符串时既无法去重也无法取消
+    if not isinstance(request_id, str) or not isinstance(session_id, str) or not request_id or not session_id:
+        connection.push({"type": "error", "request_id": request_id, "status": 400, "detail": "缺少request_id或session_id"})
+        return
+    if request_id in connection.turns:
+        connection.push({"type": "error", "request_id": request_id, "status": 409, "detail": "request_id重复"})
+        return
+
+    task = asyncio.create_task(run_chat_turn(connection, request_id, frame))
+    connection.turns[request_id] = task
+    task.add_done_callback(lambda _: connection.turns.pop(request_id, None))
+
+def cancel_chat_turn(connection: Connection, frame: dict):
+    """中断进行中的聊天，上游连接立即关闭，已生成的部分照常记录并返回"""
+    request_id = frame.get("request_id")
+    if not isinstance(request_id, str):
+        connection.push({"type": "error", "request_id": request_id, "status": 400, "detail": "缺少request_id"})
+        return
+    generation = connection.generations.get(request_id)
+    if generation is not None:
+        generation.cancel()
+        return
+    # 尚未开始生成时直接取消整轮
+    task = connection.turns.get(request_id)
+    if task is not None:
+        task.cancel()
+        connection.push({"type": "cancelled", "request_id": request_id})
+
+async def websocket_endpoint(websocket: WebSocket):
+    """WebSocket连接：在一个连接上复用聊天、流式输出、取消和会话变更通知
+
+    客户端帧：auth、chat、cancel、ping；服务端帧：ready、token、done、cancelled、error、session、pong。
+    """
+    try:
+        await wait_until_ready()
+    except HTTPException:
+        await websocket.close(code=CLOSE_TRY_AGAIN)
+        return
+
+    await websocket.accept()
+    try:
+        user = await authenticate(websocket)
+    except WebSocketDisconnect:
+        return
+    if user is None:
+        await websocket.close(code=CLOSE_POLICY_VIOLATION)
+        return
+
+    connection = Connection(websocket, user)
+    register_connection(connection)
+    connection.push({"type": "ready", "user": {"id": user.id, "username": user.username}})
+
+    try:
+        while not connection.closed:
+            try:
+                frame = json.loads(await websocket.receive_text())
+            except (ValueError, KeyError):
+                # 非JSON或二进制帧（receive_text对二进制帧抛出KeyError），与认证时的处理一致
+                connection.push({"type": "error", "status": 400, "detail": "无效的JSON"})
+                continue
+            if not isinstance(frame, dict):
+                connection.push({"type": "error", "status": 400, "detail": "无效的消息"})
+                continue
+
+            frame_type = frame.get("type")
+            if frame_type == "chat":
+                start_chat_turn(connection, frame)
+            elif frame_type == "cancel":
+                cancel_chat_turn(connection, frame)
+            elif frame_type == "ping":
+                connection.push({"type": "pong"})
+            elif frame_type != "auth":
+                connection.push({"type": "error", "status": 400, "detail": f"未知的消息类型: {frame_type}"})
+    except (WebSocketDisconnect, RuntimeError):
+        # 客户端断开，或连接已因接收过慢被关闭
+        pass
+    finally:
+        unregister_connection(connection)
+        await connection.shutdown()
@@ -0,0 +1,122 @@
+import gzip
+import json
+from typing import Any, Dict, List, Optional
+from fastapi.responses import JSONResponse
+from .models import ChatSession, Message
+from .config import compression_enabled, compression_min_size
+
+# orjson是可选依赖，未安装时退回标准库json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# brotli是可选依赖，未安装时只协商gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def dumps(content: Any) -> bytes:
+    """将内容序列化为紧凑的JSON字节串"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def loads(data: bytes) -> Any:
+    """解析JSON字节串"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def message_to_dict(message: Message) -> Dict[str, Any]:
+    """将消息转换为可直接序列化的字典"""
+    return {
+        "role": message.role,
+        "content": message.content,
+        "timestamp": message.timestamp,
+        "file_urls": message.file_urls
+    }
+
+def session_to_dict(session: ChatSession) -> Dict[str, Any]:
+    """将会话转换为可直接序列化的字典，跳过jsonable_encoder的逐字段遍历"""
+    return {
+        "id": session.id,
+        "title": session.title,
+        "messages": [message_to_dict(message) for message in session.messages],
+        "created_at": session.created_at,
+        "updated_at": session.updated_at,
+        "model": session.model,
+        "api_provider": session.api_provider,
+        "archived": session.archived
+    }
+
+def session_summary_to_dict(session: ChatSession) -> Dict[str, Any]:
+    """会话元数据，不含消息，用于变更通知"""
+    return {
+        "id": session.id,
+        "title": session.title,
+        "created_at": session.created_at,
+        "updated_at": session.updated_at,
+        "model": session.model,
+        "api_provider": session.api_provider,
+        "archived": session.archived,
+        "message_count": len(session.messages)
+    }
+
+def sessions_to_list(sessions: List[ChatSession]) -> List[Dict[str, Any]]:
+    """将会话列表转换为可直接序列化的列表"""
+    return [session_to_dict(session) for session in sessions]
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """根据Accept-Encoding请求头选择压缩算法"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token] = quality
+
+    # 优先使用压缩率更高的brotli
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """使用指定算法压缩响应体"""
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=5)
+
+class FastJSONResponse(JSONResponse):
+    """基于orjson的JSON响应，按请求协商gzip/brotli压缩"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if compression_enabled and len(self.body) >= compression_min_size:
+            accept_encoding = ""
+            for key, value in scope.get("headers", []):
+                if key == b"accept-encoding":
+                    accept_encoding = value.decode("latin-1")
+                    break
+
+            encoding = negotiate_encoding(accept_encoding)
+            if encoding:
+                self.body = compress(self.body, encoding)
+                self.headers["content-encoding"] = encoding
+                self.headers["content-length"] = str(len(self.body))
+            self.headers.append("vary", "Accept-Encoding")
+
+        await super().__call__(scope, receive, send)
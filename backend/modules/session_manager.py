@@ -1,43 +1,74 @@
 from typing import Dict, List
-from datetime import datetime
+from datetime import datetime, timedelta
 from .models import ChatSession, Message
-from .database import init_db, load_sessions_from_db, save_session_to_db, delete_session_from_db, add_message_to_db, clear_session_messages_from_db, update_session_in_db, update_message_in_db
+from .database import init_db, load_sessions_from_db, save_session_to_db, delete_session_from_db, add_message_to_db, clear_session_messages_from_db, update_session_in_db, update_message_in_db, search_sessions_in_db, load_session_messages_from_db
+from .archive import init_archive_db, load_archived_session_ids, restore_session_from_db, delete_archived_session_from_db
+from . import auth
+from .memory import enqueue_message, sync_session_memory, forget_session_memory
+from .documents import init_documents_db
+from .prompt_builder import forget_session_prompt
 
 # 全局变量存储会话
 chat_sessions: Dict[str, ChatSession] = {}
 current_session_id: str = None
 
+# 按用户分区的会话索引：用户ID -> {会话ID: 会话}，列出会话时只遍历该用户的会话
+owner_sessions: Dict[str, Dict[str, ChatSession]] = {}
+
 def initialize_default_session():
     """初始化默认会话"""
     global current_session_id, chat_sessions
     
     # 初始化数据库
     init_db()
+    init_archive_db()
+    auth.init_auth_db()
+    init_documents_db()
     
     # 从数据库加载现有会话
     chat_sessions = load_sessions_from_db()
     
-    # 如果没有会话，创建默认会话
+    # 已归档的会话只保留元数据，消息在访问时再解压
+    for session_id in load_archived_session_ids():
+        if session_id in chat_sessions:
+            chat_sessions[session_id].archived = True
+    
+    # 如果没有会话，为管理员创建默认会话
     if not chat_sessions:
         default_session = ChatSession(
             id="default",
             title="默认对话",
             messages=[],
             created_at=datetime.now().isoformat(),
-            updated_at=datetime.now().isoformat()
+            updated_at=datetime.now().isoformat(),
+            owner_id=auth.admin_user_id
         )
         chat_sessions[default_session.id] = default_session
         save_session_to_db(default_session)
     
+    # 建立按用户分区的索引
+    owner_sessions.clear()
+    for session in chat_sessions.values():
+        owner_sessions.setdefault(session.owner_id, {})[session.id] = session
+    
     # 设置当前会话ID为第一个会话
     if chat_sessions:
         current_session_id = next(iter(chat_sessions))
 
-def get_sessions() -> List[ChatSession]:
-    """获取所有聊天会话"""
-    return list(chat_sessions.values())
+def get_sessions(owner_id: str) -> List[ChatSession]:
+    """获取用户的所有聊天会话"""
+    return list(owner_sessions.get(owner_id, {}).values())
+
+def count_sessions(owner_id: str) -> int:
+    """获取用户的会话数"""
+    return len(owner_sessions.get(owner_id, {}))
+
+def search_sessions(owner_id: str, query: str, limit: int = 50) -> List[ChatSession]:
+    """在用户的会话中按标题和消息内容搜索"""
+    session_ids = search_sessions_in_db(owner_id, query, limit)
+    return [chat_sessions[session_id] for session_id in session_ids if session_id in chat_sessions]
 
-def create_session(title: str = "新对话") -> ChatSession:
+def create_session(title: str = "新对话", owner_id: str = None) -> ChatSession:
     """创建新聊天会话"""
     session_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
     new_session = ChatSession(
@@ -45,22 +76,80 @@ def create_session(title: str = "新对话") -> ChatSession:
         title=title,
         messages=[],
         created_at=datetime.now().isoformat(),
-        updated_at=datetime.now().isoformat()
+        updated_at=datetime.now().isoformat(),
+        owner_id=owner_id
     )
     chat_sessions[session_id] = new_session
+    owner_sessions.setdefault(owner_id, {})[session_id] = new_session
     save_session_to_db(new_session)
     return new_session
 
-def get_session(session_id: str) -> ChatSession:
-    """获取特定聊天会话"""
-    return chat_sessions.get(session_id)
+def add_imported_sessions(sessions: List[ChatSession]):
+    """将已写入数据库的导入会话加入内存索引，消息留在消息表中（unloaded），首次访问时再加载"""
+    for session in sessions:
+        chat_sessions[session.id] = session
+        owner_sessions.setdefault(session.owner_id, {})[session.id] = session
+        sync_session_memory(session.id)
+
+def get_session(session_id: str, owner_id: str = None) -> ChatSession:
+    """获取特定聊天会话，指定owner_id时只返回该用户的会话"""
+    session = chat_sessions.get(session_id)
+    if session and owner_id is not None and session.owner_id != owner_id:
+        return None
+    if session and session.archived:
+        rehydrate_session(session)
+    elif session and session.unloaded:
+        load_session_messages(session)
+    return session
+
+def rehydrate_session(session: ChatSession):
+    """将归档会话的消息解压回内存和消息表"""
+    messages = restore_session_from_db(session.id) or []
+    session.messages = [Message(**message) for message in messages]
+    session.archived = False
+
+def load_session_messages(session: ChatSession):
+    """从消息表加载导入的会话的消息"""
+    session.messages = [Message(**message) for message in load_session_messages_from_db(session.id)]
+    session.unloaded = False
+
+def find_idle_sessions(idle_days: float) -> List[tuple]:
+    """找出超过指定天数未更新的会话，返回(会话, 当时的更新时间)列表"""
+    cutoff = (datetime.now() - timedelta(days=idle_days)).isoformat()
+    return [
+        (session, session.updated_at)
+        for session in chat_sessions.values()
+        if not session.archived and session.messages and session.updated_at < cutoff
+    ]
+
+def mark_session_archived(session: ChatSession, updated_at: str) -> bool:
+    """消息已在后台线程中移入归档表后，释放内存中的消息
+
+    归档期间会话被删除或修改时，内存中的状态为准：删除残留的归档，或重新写入消息。
+    返回会话是否仍保持归档状态。
+    """
+    if chat_sessions.get(session.id) is not session:
+        delete_archived_session_from_db(session.id)
+        return False
+    if session.archived:
+        return True
+    if session.updated_at != updated_at:
+        save_session_to_db(session)
+        delete_archived_session_from_db(session.id)
+        return False
+
+    # 释放内存中的消息，只保留会话元数据
+    session.messages = []
+    session.archived = True
+    forget_session_prompt(session.id)
+    return True
 
 def update_session(session_id: str, title: str = None, model: str = None, api_provider: str = None) -> ChatSession:
     """更新会话配置"""
-    if session_id not in chat_sessions:
+    session = get_session(session_id)
+    if not session:
         return None
     
-    session = chat_sessions[session_id]
     if title is not None:
         session.title = title
     if model is not None:
@@ -77,69 +166,75 @@ def update_session(session_id: str, title: str = None, model: str = None, api_pr
 def delete_session(session_id: str) -> bool:
     """删除聊天会话"""
     if session_id in chat_sessions:
-        del chat_sessions[session_id]
+        session = chat_sessions.pop(session_id)
+        owner_sessions.get(session.owner_id, {}).pop(session_id, None)
         # 从数据库中删除会话
         delete_session_from_db(session_id)
+        delete_archived_session_from_db(session_id)
+        forget_session_prompt(session_id)
+        forget_session_memory(session_id)
         return True
     return False
 
 def add_message_to_session(session_id: str, message: Message) -> ChatSession:
     """向会话添加消息"""
-    if session_id in chat_sessions:
-        chat_sessions[session_id].messages.append(message)
-        chat_sessions[session_id].updated_at = datetime.now().isoformat()
+    session = get_session(session_id)
+    if session:
+        session.messages.append(message)
+        session.updated_at = datetime.now().isoformat()
         # 更新会话标题为第一条消息的前10个字符
-        if len(chat_sessions[session_id].messages) == 1:
-            chat_sessions[session_id].title = message.content[:10] + "..." if len(message.content) > 10 else message.content
+        if len(session.messages) == 1:
+            session.title = message.content[:10] + "..." if len(message.content) > 10 else message.content
+            update_session_in_db(session_id, title=session.title)
         
-        # 将消息保存到数据库
+        # 将消息保存到数据库（只追加新消息，不重写整个会话）
         add_message_to_db(session_id, message)
         
-        # 更新会话到数据库
-        save_session_to_db(chat_sessions[session_id])
+        # 记忆功能启用时，由后台线程异步嵌入新消息；向量以消息在会话中的位置为键，归档和解压后仍然有效
+        enqueue_message(session_id, len(session.messages) - 1, session.owner_id, message.content)
         
-        return chat_sessions[session_id]
+        return session
     return None
 
 def edit_message_in_session(session_id: str, message_index: int, new_message: Message) -> ChatSession:
     """编辑会话中的消息"""
-    if session_id in chat_sessions and 0 <= message_index < len(chat_sessions[session_id].messages):
-        chat_sessions[session_id].messages[message_index] = new_message
-        chat_sessions[session_id].updated_at = datetime.now().isoformat()
+    session = get_session(session_id)
+    if session and 0 <= message_index < len(session.messages):
+        session.messages[message_index] = new_message
+        session.updated_at = datetime.now().isoformat()
         
         # 更新数据库中的消息
         update_message_in_db(session_id, message_index, new_message)
+        sync_session_memory(session_id)
         
-        # 更新会话到数据库
-        save_session_to_db(chat_sessions[session_id])
-        
-        return chat_sessions[session_id]
+        return session
     return None
 
 def delete_message_from_session(session_id: str, message_index: int) -> ChatSession:
     """从会话中删除消息"""
-    if session_id in chat_sessions and 0 <= message_index < len(chat_sessions[session_id].messages):
+    session = get_session(session_id)
+    if session and 0 <= message_index < len(session.messages):
         # 删除消息
-        chat_sessions[session_id].messages.pop(message_index)
-        chat_sessions[session_id].updated_at = datetime.now().isoformat()
+        session.messages.pop(message_index)
+        session.updated_at = datetime.now().isoformat()
         
         # 重新保存所有消息到数据库（因为索引可能已改变）
-        save_session_to_db(chat_sessions[session_id])
+        save_session_to_db(session)
+        sync_session_memory(session_id)
         
-        return chat_sessions[session_id]
+        return session
     return None
 
 def clear_session_messages(session_id: str) -> ChatSession:
     """清空会话消息"""
-    if session_id in chat_sessions:
-        chat_sessions[session_id].messages = []
-        chat_sessions[session_id].updated_at = datetime.now().isoformat()
+    session = get_session(session_id)
+    if session:
+        session.messages = []
+        session.updated_at = datetime.now().isoformat()
         
         # 清空数据库中的消息
         clear_session_messages_from_db(session_id)
+        sync_session_memory(session_id)
         
-        # 更新会话到数据库
-        save_session_to_db(chat_sessions[session_id])
-        
-        return chat_sessions[session_id]
+        return session
     return None
@@ -0,0 +1,73 @@
+import time
+
+# 开始导入应用的时间，作为启动耗时的起点，需在其他导入之前记录
+process_start = time.perf_counter()
+
+import asyncio
+from fastapi import HTTPException
+from .config import get_registry, ready_timeout_seconds
+from .session_manager import initialize_default_session
+from .memory import start_memory
+from .documents import start_document_worker
+from .serialization import FastJSONResponse
+
+# 预热完成后置位，请求在此之前等待
+ready_event = asyncio.Event()
+
+# 启动耗时指标（秒）
+startup_metrics = {
+    "import_seconds": None,
+    "warmup_seconds": None,
+    "ready_seconds": None
+}
+
+def mark_imported():
+    """记录应用模块导入完成的耗时"""
+    startup_metrics["import_seconds"] = round(time.perf_counter() - process_start, 4)
+
+async def warm_up():
+    """在后台加载会话并预建默认客户端，完成后标记就绪"""
+    start = time.perf_counter()
+    
+    # 加载整个数据库是同步操作，放到线程中执行，服务器可以先开始接收连接
+    await asyncio.to_thread(initialize_default_session)
+    await asyncio.to_thread(start_memory)
+    await asyncio.to_thread(start_document_worker)
+    
+    registry = get_registry()
+    await asyncio.to_thread(registry.get_async_client, registry.default_provider)
+    
+    now = time.perf_counter()
+    startup_metrics["warmup_seconds"] = round(now - start, 4)
+    startup_metrics["ready_seconds"] = round(now - process_start, 4)
+    ready_event.set()
+    print(f"服务已就绪，启动耗时 {startup_metrics['ready_seconds']} 秒")
+
+async def wait_until_ready():
+    """等待预热完成，超时返回503"""
+    if ready_event.is_set():
+        return
+    try:
+        await asyncio.wait_for(ready_event.wait(), timeout=ready_timeout_seconds)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="服务正在启动，请稍后重试")
+
+class ReadinessMiddleware:
+    """预热完成前的请求等待就绪，/ready 用于探测启动状态，不等待
+
+    使用纯ASGI中间件而不是@app.middleware("http")，后者会包装receive，
+    使端点无法通过request.is_disconnected()检测到客户端断开。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] != "/ready":
+            try:
+                await wait_until_ready()
+            except HTTPException as e:
+                response = FastJSONResponse({"detail": e.detail}, status_code=e.status_code)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
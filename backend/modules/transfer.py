@@ -0,0 +1,542 @@
+import os
+import json
+import uuid
+import zlib
+import base64
+import hashlib
+import sqlite3
+from typing import Dict, Iterator, List, Optional
+from datetime import datetime
+from .models import ChatSession
+from .database import DB_PATH, UPLOAD_DIR
+from .archive import decompress_payload
+from .serialization import dumps, loads
+from .documents import register_upload
+from .prompt_builder import is_image_file
+from .config import get_registry
+from . import auth
+
+# 导出格式版本，导入时拒绝更高的版本
+EXPORT_FORMAT_VERSION = 1
+
+# 按主键分页读取，每页读完即释放数据库的共享锁，长时间导出不会阻塞写入
+SESSION_PAGE_SIZE = 100
+MESSAGE_PAGE_SIZE = 1000
+
+# 导出时攒够这么多字节再交给响应或压缩器
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+# 每条file_data记录携带的文件字节数
+FILE_CHUNK_BYTES = 256 * 1024
+
+# 导入时每个事务最多包含的消息数（或空会话数）和消息内容的字节数
+IMPORT_BATCH_MESSAGES = 5000
+IMPORT_BATCH_BYTES = 8 * 1024 * 1024
+
+# 每次解压的输出上限，以及单行的长度上限，防止压缩炸弹或没有换行的输入耗尽内存
+DECOMPRESS_CHUNK_BYTES = 1024 * 1024
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+def open_connection() -> sqlite3.Connection:
+    """打开可跨线程使用的连接，流式响应的每一块可能在不同的线程池线程中生成"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def upload_path(file_url: str) -> Optional[str]:
+    """将上传文件URL转换为本地路径，不指向上传目录中文件的URL返回None"""
+    prefix = f"/{UPLOAD_DIR}/"
+    if not isinstance(file_url, str) or not file_url.startswith(prefix):
+        return None
+    name = file_url[len(prefix):]
+    if not name or name != os.path.basename(name) or name.startswith("."):
+        return None
+    return os.path.join(UPLOAD_DIR, name)
+
+def file_sha256(file_path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def iter_session_rows(conn: sqlite3.Connection, owner_id: Optional[str]) -> Iterator[sqlite3.Row]:
+    """按ID分页遍历会话，owner_id为None时遍历所有用户的会话"""
+    last_id = ""
+    while True:
+        params = [last_id]
+        owner_filter = ""
+        if owner_id is not None:
+            owner_filter = "AND s.owner_id = ?"
+            params.append(owner_id)
+        params.append(SESSION_PAGE_SIZE)
+        rows = conn.execute(f'''
+            SELECT s.id, s.title, s.created_at, s.updated_at, s.model, s.api_provider, u.username AS owner
+            FROM sessions s
+            LEFT JOIN users u ON u.id = s.owner_id
+            WHERE s.id > ? {owner_filter}
+            ORDER BY s.id
+            LIMIT ?
+        ''', params).fetchall()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1]['id']
+
+def iter_session_messages(conn: sqlite3.Connection, session_id: str) -> Iterator[dict]:
+    """按顺序遍历会话的消息
+
+    消息表按页读取；归档会话整体解压（与打开会话时相同），内存占用以最大的归档会话为上限。
+    """
+    row = conn.execute(
+        "SELECT codec, payload FROM archived_messages WHERE session_id = ?", (session_id,)
+    ).fetchone()
+    if row:
+        yield from loads(decompress_payload(row['codec'], row['payload']))
+        return
+
+    last_id = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, role, content, file_urls, timestamp FROM messages
+            WHERE session_id = ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (session_id, last_id, MESSAGE_PAGE_SIZE)).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield {
+                'role': row['role'],
+                'content': row['content'],
+                'timestamp': row['timestamp'],
+                'file_urls': json.loads(row['file_urls']) if row['file_urls'] else None
+            }
+        last_id = rows[-1]['id']
+
+def iter_file_records(conn: sqlite3.Connection, file_url: str) -> Iterator[dict]:
+    """产出上传文件的描述记录和分块的数据记录，文件已不存在时不产出"""
+    file_path = upload_path(file_url)
+    if file_path is None or not os.path.isfile(file_path):
+        return
+    row = conn.execute("SELECT original_name FROM uploaded_files WHERE file_url = ?", (file_url,)).fetchone()
+
+    try:
+        with open(file_path, "rb") as f:
+            yield {
+                "type": "file",
+                "url": file_url,
+                "name": row['original_name'] if row else None,
+                "size": os.fstat(f.fileno()).st_size
+            }
+            while True:
+                chunk = f.read(FILE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield {"type": "file_data", "url": file_url, "data": base64.b64encode(chunk).decode("ascii")}
+    except OSError as e:
+        # 导出期间文件被回收，导入时按已写入的部分处理
+        print(f"读取上传文件 {file_path} 失败: {e}")
+
+def iter_export_records(owner_id: Optional[str] = None, include_files: bool = True) -> Iterator[dict]:
+    """按导出格式产出记录：首条为export，之后每个会话一条session记录，随后是它的message记录；
+    include_files时消息引用的上传文件在第一次被引用的消息之前以file和file_data记录给出
+    """
+    conn = open_connection()
+    try:
+        yield {
+            "type": "export",
+            "version": EXPORT_FORMAT_VERSION,
+            "exported_at": datetime.now().isoformat(),
+            "include_files": include_files
+        }
+
+        exported_files = set()
+        for row in iter_session_rows(conn, owner_id):
+            yield {
+                "type": "session",
+                "id": row['id'],
+                "title": row['title'],
+                "created_at": row['created_at'],
+                "updated_at": row['updated_at'],
+                "model": row['model'],
+                "api_provider": row['api_provider'],
+                "owner": row['owner']
+            }
+            for message in iter_session_messages(conn, row['id']):
+                if include_files:
+                    for file_url in message.get('file_urls') or ():
+                        if file_url not in exported_files:
+                            exported_files.add(file_url)
+                            yield from iter_file_records(conn, file_url)
+                yield {"type": "message", "session_id": row['id'], **message}
+    finally:
+        conn.close()
+
+def iter_export(owner_id: Optional[str] = None, include_files: bool = True, compress: bool = False) -> Iterator[bytes]:
+    """以NDJSON逐块产出导出数据，compress时为gzip格式，内存占用与导出的数据量无关"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = bytearray()
+
+    for record in iter_export_records(owner_id, include_files):
+        buffer += dumps(record)
+        buffer += b"\n"
+        if len(buffer) >= EXPORT_CHUNK_BYTES:
+            data = compressor.compress(buffer) if compressor else bytes(buffer)
+            buffer.clear()
+            if data:
+                yield data
+
+    data = bytes(buffer)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+def optional_str(record: dict, key: str) -> Optional[str]:
+    """读取可省略的字符串字段，类型不对时抛出ValueError"""
+    value = record.get(key)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"无效的字段: {key}")
+    return value
+
+class Importer:
+    """逐块读取导出数据并写入数据库，内存占用与导入的数据量无关
+
+    输入是否经过gzip压缩按开头的魔数自动识别。每个会话获得新的ID，归属于导入的用户
+    （keep_owners时按用户名归属到已存在的用户）。消息分批写入消息表，可以被搜索和记忆检索，
+    内存索引中只加入会话元数据，首次打开时才加载消息。上传文件写入上传目录，
+    文件名冲突且内容不同时改用新的文件名，消息中的文件URL随之替换。
+
+    每满IMPORT_BATCH_MESSAGES条消息或IMPORT_BATCH_BYTES字节提交一次事务，一个会话可以跨多个事务，
+    内存中只保留当前批次，与单个会话的大小无关。出错时已提交的完整会话保留，写了一半的会话被删除。
+    """
+
+    def __init__(self, owner_id: str, keep_owners: bool = False, session_limit: int = 0):
+        self.owner_id = owner_id
+        self.keep_owners = keep_owners
+        # 最多导入的会话数，0表示不限制
+        self.session_limit = session_limit
+        self.conn = open_connection()
+
+        self.detected = False
+        self.head = b""
+        self.decompressor = None
+        self.pending = bytearray()
+        self.header: Optional[dict] = None
+
+        self.session: Optional[dict] = None  # 正在读取的会话
+        self.file: Optional[dict] = None  # 正在写入的上传文件
+        self.last_session_id: Optional[str] = None
+        # 导出数据中的文件URL -> 导入后的URL
+        self.file_urls: Dict[str, str] = {}
+        # 用户名 -> 用户ID
+        self.owners: Dict[str, str] = {}
+
+        # 当前批次
+        self.session_rows: List[tuple] = []
+        self.message_rows: List[tuple] = []
+        self.stubs: List[ChatSession] = []
+        self.batch_bytes = 0
+
+        # 已提交、尚未加入内存索引的会话
+        self.committed: List[ChatSession] = []
+        self.stats = {"sessions": 0, "messages": 0, "files": 0}
+
+    def feed(self, data: bytes):
+        """处理一块输入"""
+        for text in self.iter_decompressed(data):
+            self.feed_text(text)
+
+    def finish(self):
+        """输入结束，提交剩余的批次"""
+        if not self.detected:
+            self.detected = True
+            self.feed_text(self.head)
+        if self.decompressor is not None and not self.decompressor.eof:
+            raise ValueError("压缩数据不完整")
+        if self.pending.strip():
+            self.handle(loads(self.pending))
+            self.pending.clear()
+        if self.header is None:
+            raise ValueError("不是有效的导出文件")
+
+        self.finish_file()
+        self.finish_session()
+        self.flush()
+
+    def take_committed(self) -> List[ChatSession]:
+        """取出已提交的会话，由调用方加入内存索引"""
+        sessions, self.committed = self.committed, []
+        return sessions
+
+    def close(self):
+        """释放连接并删除未写完的文件，未提交的批次丢弃"""
+        if self.file is not None:
+            self.file["handle"].close()
+            try:
+                os.remove(self.file["path"])
+            except OSError:
+                pass
+            self.file = None
+        if self.session is not None and self.session["flushed"]:
+            # 会话只提交了一部分消息
+            with self.conn:
+                self.conn.execute("DELETE FROM messages WHERE session_id = ?", (self.session["id"],))
+                self.conn.execute("DELETE FROM sessions WHERE id = ?", (self.session["id"],))
+            self.stats["messages"] -= self.session["flushed"]
+            self.session = None
+        self.conn.close()
+
+    def iter_decompressed(self, data: bytes) -> Iterator[bytes]:
+        if not self.detected:
+            self.head += data
+            if len(self.head) < len(GZIP_MAGIC):
+                return
+            data, self.head = self.head, b""
+            self.detected = True
+            if data.startswith(GZIP_MAGIC):
+                self.decompressor = zlib.decompressobj(31)
+
+        if self.decompressor is None:
+            yield data
+            return
+
+        while data:
+            try:
+                text = self.decompressor.decompress(data, DECOMPRESS_CHUNK_BYTES)
+            except zlib.error as e:
+                raise ValueError(f"压缩数据损坏: {e}")
+            yield text
+            if self.decompressor.eof:
+                # 多个gzip成员首尾相接
+                data = self.decompressor.unused_data
+                if data:
+                    self.decompressor = zlib.decompressobj(31)
+            else:
+                data = self.decompressor.unconsumed_tail
+
+    def feed_text(self, data: bytes):
+        self.pending += data
+        start = 0
+        while True:
+            end = self.pending.find(b"\n", start)
+            if end < 0:
+                break
+            line = self.pending[start:end]
+            start = end + 1
+            if line.strip():
+                self.handle(loads(line))
+        del self.pending[:start]
+        if len(self.pending) > MAX_LINE_BYTES:
+            raise ValueError("单行数据过长")
+
+    def handle(self, record):
+        if not isinstance(record, dict):
+            raise ValueError("无效的记录")
+        record_type = record.get("type")
+
+        if self.header is None:
+            if record_type != "export":
+                raise ValueError("不是有效的导出文件")
+            if not isinstance(record.get("version"), int) or record["version"] > EXPORT_FORMAT_VERSION:
+                raise ValueError(f"不支持的导出格式版本: {record.get('version')}")
+            self.header = record
+            return
+
+        if record_type != "file_data":
+            self.finish_file()
+
+        if record_type == "session":
+            self.start_session(record)
+        elif record_type == "message":
+            self.add_message(record)
+        elif record_type == "file":
+            self.start_file(record)
+        elif record_type == "file_data":
+            self.write_file_data(record)
+        # 未知类型的记录忽略，便于以后扩展导出格式
+
+    def next_session_id(self) -> str:
+        """与新建会话相同的时间戳ID，同一微秒内导入多个会话时顺延"""
+        session_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        if self.last_session_id is not None and session_id <= self.last_session_id:
+            session_id = str(int(self.last_session_id) + 1)
+        self.last_session_id = session_id
+        return session_id
+
+    def resolve_owner(self, username: Optional[str]) -> str:
+        if not self.keep_owners or not username:
+            return self.owner_id
+        if username not in self.owners:
+            user = auth.get_user_by_username(username)
+            self.owners[username] = user.id if user else self.owner_id
+        return self.owners[username]
+
+    def start_session(self, record: dict):
+        self.finish_session()
+        if self.session_limit and self.stats["sessions"] + len(self.stubs) >= self.session_limit:
+            raise ValueError("会话数量已达上限")
+
+        registry = get_registry()
+        now = datetime.now().isoformat()
+        self.session = {
+            "id": self.next_session_id(),
+            "source_id": record.get("id"),
+            "title": str(record.get("title") or "新对话"),
+            "created_at": optional_str(record, "created_at") or now,
+            "updated_at": optional_str(record, "updated_at") or now,
+            "model": optional_str(record, "model") or registry.default_model,
+            "api_provider": optional_str(record, "api_provider") or registry.default_provider,
+            "owner_id": self.resolve_owner(optional_str(record, "owner")),
+            "count": 0,
+            # 已提交的消息数
+            "flushed": 0
+        }
+        # 会话行与它的第一批消息在同一个事务中写入
+        self.session_rows.append((
+            self.session["id"], self.session["title"], self.session["created_at"], self.session["updated_at"],
+            self.session["model"], self.session["api_provider"], self.session["owner_id"]
+        ))
+
+    def add_message(self, record: dict):
+        session = self.session
+        if session is None:
+            raise ValueError("消息出现在会话之前")
+        if record.get("session_id") not in (None, session["source_id"]):
+            raise ValueError("消息不属于当前会话")
+        role, content = record.get("role"), record.get("content")
+        if not isinstance(role, str) or not isinstance(content, str):
+            raise ValueError("无效的消息")
+        timestamp = optional_str(record, "timestamp")
+
+        # 与Message模型的字段类型一致，否则写入后会话无法打开
+        file_urls = record.get("file_urls") or None
+        if file_urls is not None and (
+            not isinstance(file_urls, list) or not all(isinstance(file_url, str) for file_url in file_urls)
+        ):
+            raise ValueError("无效的文件列表")
+        if file_urls:
+            file_urls = [self.file_urls.get(file_url, file_url) for file_url in file_urls]
+
+        self.message_rows.append((
+            session["id"],
+            role,
+            content,
+            json.dumps(file_urls) if file_urls else None,
+            timestamp or datetime.now().isoformat()
+        ))
+        session["count"] += 1
+        self.batch_bytes += len(content)
+
+        if len(self.message_rows) >= IMPORT_BATCH_MESSAGES or self.batch_bytes >= IMPORT_BATCH_BYTES:
+            self.flush()
+
+    def finish_session(self):
+        session = self.session
+        if session is None:
+            return
+        self.session = None
+
+        # 有消息的会话先只加入元数据，首次打开时再从消息表加载
+        stub = ChatSession(
+            id=session["id"],
+            title=session["title"],
+            messages=[],
+            created_at=session["created_at"],
+            updated_at=session["updated_at"],
+            model=session["model"],
+            api_provider=session["api_provider"],
+            unloaded=session["count"] > 0,
+            owner_id=session["owner_id"]
+        )
+        if session["count"] and session["flushed"] == session["count"]:
+            # 消息恰好在上一批中全部提交
+            self.stats["sessions"] += 1
+            self.committed.append(stub)
+        else:
+            self.stubs.append(stub)
+
+        if len(self.message_rows) + len(self.session_rows) >= IMPORT_BATCH_MESSAGES:
+            self.flush()
+
+    def flush(self):
+        """在一个事务中提交当前批次"""
+        if not self.session_rows and not self.message_rows and not self.stubs:
+            return
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO sessions (id, title, created_at, updated_at, model, api_provider, owner_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', self.session_rows)
+            self.conn.executemany('''
+                INSERT INTO messages (session_id, role, content, file_urls, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', self.message_rows)
+
+        if self.session is not None:
+            self.session["flushed"] = self.session["count"]
+        # 只有读完的会话才计入并交给调用方
+        self.stats["sessions"] += len(self.stubs)
+        self.stats["messages"] += len(self.message_rows)
+        self.committed.extend(self.stubs)
+        self.session_rows = []
+        self.message_rows = []
+        self.stubs = []
+        self.batch_bytes = 0
+
+    def start_file(self, record: dict):
+        file_url = record.get("url")
+        if upload_path(file_url) is None:
+            # 无法识别的URL，数据记录随之忽略
+            return
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        # 临时文件在写完后改名；中途失败残留的文件由上传文件回收清理
+        temp_path = os.path.join(UPLOAD_DIR, f".import-{uuid.uuid4().hex}.part")
+        self.file = {
+            "url": file_url,
+            "name": optional_str(record, "name") or os.path.basename(file_url),
+            "path": temp_path,
+            "handle": open(temp_path, "wb"),
+            "hasher": hashlib.sha256(),
+            "size": 0
+        }
+
+    def write_file_data(self, record: dict):
+        if self.file is None or record.get("url") != self.file["url"]:
+            return
+        chunk = base64.b64decode(optional_str(record, "data") or "", validate=True)
+        self.file["hasher"].update(chunk)
+        self.file["handle"].write(chunk)
+        self.file["size"] += len(chunk)
+
+    def finish_file(self):
+        """文件写完后放到最终位置，同名同内容的文件已存在时直接复用"""
+        file = self.file
+        if file is None:
+            return
+        self.file = None
+        file["handle"].close()
+
+        file_url = file["url"]
+        file_path = upload_path(file_url)
+        content_hash = file["hasher"].hexdigest()
+        if os.path.exists(file_path):
+            if os.path.getsize(file_path) == file["size"] and file_sha256(file_path) == content_hash:
+                os.remove(file["path"])
+                self.file_urls[file_url] = file_url
+                return
+            file_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}{os.path.splitext(file_path)[1]}")
+        os.replace(file["path"], file_path)
+
+        new_url = f"/{file_path.replace(os.sep, '/')}"
+        self.file_urls[file_url] = new_url
+        self.stats["files"] += 1
+        # 与上传接口相同，非图片文件在后台提取文本
+        if not is_image_file(file_path):
+            register_upload(new_url, content_hash, file["name"], file["size"], file_path)
@@ -4,23 +4,26 @@ import SessionManager from './components/SessionManager';
 import ModelSelector from './components/ModelSelector';
 import Login from './components/Login';
 import { getApiBaseUrl } from './utils/api';
+import { ChatSocket } from './utils/socket';
 import './App.css';
 
 function App() {
   const [isLoggedIn, setIsLoggedIn] = useState(false);
   const [username, setUsername] = useState('');
-  const [password, setPassword] = useState('');
+  const [token, setToken] = useState('');
   const [sessions, setSessions] = useState([]);
   const [currentSession, setCurrentSession] = useState(null);
   const [models, setModels] = useState([]);
   const [providers, setProviders] = useState([]);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
+  const socketRef = useRef(null);
+  const currentSessionRef = useRef(null);
 
   // 登录处理函数
-  const handleLogin = (user, pass) => {
+  const handleLogin = (user, accessToken) => {
     setUsername(user);
-    setPassword(pass);
+    setToken(accessToken);
     setIsLoggedIn(true);
   };
 
@@ -31,9 +34,24 @@ function App() {
     }
   }, [isLoggedIn]);
 
+  // 登录后建立WebSocket连接，用于流式聊天和接收会话变更通知
+  useEffect(() => {
+    if (!isLoggedIn) return undefined;
+    const socket = new ChatSocket(token, handleSessionChange);
+    socketRef.current = socket;
+    return () => {
+      socket.close();
+      socketRef.current = null;
+    };
+  }, [isLoggedIn, token]);
+
+  useEffect(() => {
+    currentSessionRef.current = currentSession;
+  }, [currentSession]);
+
   // 创建带认证头的fetch选项
   const createFetchOptions = (options = {}) => {
-    const authHeader = 'Basic ' + btoa(username + ':' + password);
+    const authHeader = 'Bearer ' + token;
     return {
       ...options,
       headers: {
@@ -90,6 +108,47 @@ function App() {
     }
   };
 
+  // 重新获取会话的完整内容
+  const refreshSession = async (sessionId) => {
+    try {
+      const response = await fetch(`${getApiBaseUrl()}/sessions/${sessionId}`, createFetchOptions());
+      const data = await response.json();
+      if (data.error) return;
+      setCurrentSession(prev => (prev && prev.id === data.id ? data : prev));
+      setSessions(prevSessions => prevSessions.map(s => s.id === data.id ? data : s));
+    } catch (err) {
+      setError('获取会话失败: ' + err.message);
+    }
+  };
+
+  // 处理其他窗口或设备上的会话变更通知
+  const handleSessionChange = (frame) => {
+    if (frame.event === 'deleted') {
+      setSessions(prevSessions => prevSessions.filter(s => s.id !== frame.session_id));
+      setCurrentSession(prev => (prev && prev.id === frame.session_id ? null : prev));
+      return;
+    }
+
+    const summary = frame.session;
+    const current = currentSessionRef.current;
+    if (current && current.id === summary.id) {
+      // 当前会话在别处发生变化时重新获取；本窗口自己的修改已是最新，无需重复获取
+      if (current.updated_at !== summary.updated_at) {
+        refreshSession(summary.id);
+      }
+      return;
+    }
+
+    // 其他会话只更新元数据，切换到该会话时再获取消息
+    setSessions(prevSessions => {
+      const existing = prevSessions.find(s => s.id === summary.id);
+      const updated = { ...(existing || { messages: [] }), ...summary, stale: true };
+      return existing
+        ? prevSessions.map(s => s.id === summary.id ? updated : s)
+        : [...prevSessions, updated];
+    });
+  };
+
   // 创建新会话
   const createNewSession = async (title = '新对话') => {
     try {
@@ -105,8 +164,24 @@ function App() {
   };
 
   // 切换会话
-  const switchSession = (session) => {
+  const switchSession = async (session) => {
     setCurrentSession(session);
+
+    // 已归档或在别处更新过的会话只包含元数据，需要从后端重新获取消息
+    if (session.archived || session.stale) {
+      try {
+        const response = await fetch(`${getApiBaseUrl()}/sessions/${session.id}`, createFetchOptions());
+        const data = await response.json();
+        if (data.error) {
+          setError(data.error);
+          return;
+        }
+        setCurrentSession(data);
+        setSessions(prevSessions => prevSessions.map(s => s.id === data.id ? data : s));
+      } catch (err) {
+        setError('获取会话失败: ' + err.message);
+      }
+    }
   };
 
   // 删除会话
@@ -192,6 +267,13 @@ function App() {
     setLoading(true);
     setError(null);
     
+    // WebSocket可用时流式接收回复
+    const socket = socketRef.current;
+    if (socket && socket.isReady()) {
+      await streamMessage(socket, updatedCurrentSession, message, fileUrls);
+      return;
+    }
+    
     try {
       const requestBody = {
         message: message,
@@ -229,6 +311,58 @@ function App() {
     }
   };
 
+  // 通过WebSocket发送消息，增量追加到助手消息中
+  const streamMessage = async (socket, session, message, fileUrls) => {
+    const sessionId = session.id;
+    const placeholder = {
+      role: 'assistant',
+      content: '',
+      timestamp: new Date().toISOString()
+    };
+    setCurrentSession({ ...session, messages: [...session.messages, placeholder] });
+
+    const appendDelta = (delta) => {
+      setCurrentSession(prev => {
+        if (!prev || prev.id !== sessionId) return prev;
+        const messages = [...prev.messages];
+        const last = messages[messages.length - 1];
+        messages[messages.length - 1] = { ...last, content: last.content + delta };
+        return { ...prev, messages };
+      });
+    };
+
+    try {
+      const { promise } = socket.chat(sessionId, message, fileUrls, appendDelta);
+      const done = await promise;
+      const finalSession = {
+        ...session,
+        ...done.session,
+        messages: [...session.messages, done.response]
+      };
+      setCurrentSession(prev => (prev && prev.id === sessionId ? finalSession : prev));
+      setSessions(prevSessions => prevSessions.map(s => s.id === sessionId ? finalSession : s));
+    } catch (err) {
+      setError('发送消息失败: ' + err.message);
+      // 失败时以后端记录的内容为准
+      refreshSession(sessionId);
+    } finally {
+      setLoading(false);
+    }
+  };
+
+  // 中断当前会话中进行中的回复，已生成的部分会保留
+  const cancelGeneration = async () => {
+    if (!currentSession) return;
+    
+    try {
+      await fetch(`${getApiBaseUrl()}/sessions/${currentSession.id}/cancel`, createFetchOptions({
+        method: 'POST'
+      }));
+    } catch (err) {
+      setError('停止生成失败: ' + err.message);
+    }
+  };
+
   // 编辑消息
   const editMessage = async (messageIndex, newContent) => {
     if (!currentSession) return;
@@ -360,12 +494,13 @@ function App() {
           <ChatBox 
             session={currentSession}
             onSendMessage={sendMessage}
+            onCancel={cancelGeneration}
             onClearSession={clearCurrentSession}
             onEditMessage={editMessage}
             onDeleteMessage={deleteMessage}
             loading={loading}
             username={username}
-            password={password}
+            token={token}
           />
         </div>
       </div>
@@ -1,7 +1,7 @@
 import React, { useState, useRef, useEffect } from 'react';
 import './ChatBox.css';
 
-const ChatBox = ({ session, onSendMessage, onClearSession, loading, onEditMessage, onDeleteMessage, username, password }) => {
+const ChatBox = ({ session, onSendMessage, onCancel, onClearSession, loading, onEditMessage, onDeleteMessage, username, token }) => {
   const [inputValue, setInputValue] = useState('');
   const [editingMessageIndex, setEditingMessageIndex] = useState(null);
   const [editingMessageContent, setEditingMessageContent] = useState('');
@@ -97,7 +97,7 @@ const ChatBox = ({ session, onSendMessage, onClearSession, loading, onEditMessag
         const apiBaseUrl = process.env.REACT_APP_API_BASE_URL || 'http://localhost:8000';
         
         // 创建带认证头的请求
-        const authHeader = 'Basic ' + btoa(username + ':' + password);
+        const authHeader = 'Bearer ' + token;
         const response = await fetch(`${apiBaseUrl}/upload`, {
           method: 'POST',
           headers: {
@@ -285,13 +285,22 @@ const ChatBox = ({ session, onSendMessage, onClearSession, loading, onEditMessag
             >
               {isUploading ? '上传中...' : '📎'}
             </button>
-            <button 
-              onClick={handleSend}
-              disabled={(!inputValue.trim() && uploadedFiles.length === 0) || loading}
-              className="send-btn"
-            >
-              {loading ? '发送中...' : '发送'}
-            </button>
+            {loading && onCancel ? (
+              <button 
+                onClick={onCancel}
+                className="send-btn"
+              >
+                停止
+              </button>
+            ) : (
+              <button 
+                onClick={handleSend}
+                disabled={(!inputValue.trim() && uploadedFiles.length === 0) || loading}
+                className="send-btn"
+              >
+                {loading ? '发送中...' : '发送'}
+              </button>
+            )}
           </div>
         </div>
       )}
@@ -16,17 +16,19 @@ const Login = ({ onLogin }) => {
     }
     
     try {
-      // 测试认证信息
-      const response = await fetch(`${getApiBaseUrl()}/`, {
-        method: 'GET',
+      // 校验用户名和密码，换取访问令牌
+      const response = await fetch(`${getApiBaseUrl()}/auth/login`, {
+        method: 'POST',
         headers: {
-          'Authorization': 'Basic ' + btoa(username + ':' + password)
-        }
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ username, password })
       });
       
       if (response.ok) {
         // 认证成功，调用父组件的登录函数
-        onLogin(username, password);
+        const data = await response.json();
+        onLogin(username, data.token);
       } else {
         setError('用户名或密码错误');
       }
@@ -0,0 +1,108 @@
+import { getApiBaseUrl } from './api';
+
+// 获取WebSocket地址
+export const getWebSocketUrl = () => {
+  return getApiBaseUrl().replace(/^http/, 'ws') + '/ws';
+};
+
+// 在一个WebSocket连接上进行聊天、接收流式输出、取消和会话变更通知，断开后自动重连
+export class ChatSocket {
+  constructor(token, onSessionChange) {
+    this.token = token;
+    this.onSessionChange = onSessionChange;
+    this.turns = new Map();
+    this.nextRequestId = 1;
+    this.retryDelay = 1000;
+    this.closed = false;
+    this.ready = false;
+    this.connect();
+  }
+
+  connect() {
+    const ws = new WebSocket(getWebSocketUrl());
+    this.ws = ws;
+
+    ws.onopen = () => {
+      // 浏览器无法为WebSocket设置请求头，令牌作为第一帧发送
+      ws.send(JSON.stringify({ type: 'auth', token: this.token }));
+    };
+
+    ws.onmessage = (event) => {
+      const frame = JSON.parse(event.data);
+      const turn = frame.request_id ? this.turns.get(frame.request_id) : null;
+
+      switch (frame.type) {
+        case 'ready':
+          this.ready = true;
+          this.retryDelay = 1000;
+          break;
+        case 'token':
+          if (turn) turn.onToken(frame.delta);
+          break;
+        case 'done':
+        case 'cancelled':
+          if (turn) {
+            this.turns.delete(frame.request_id);
+            // 被中断的回复同样包含已记录的部分内容；生成开始前就被取消时没有回复
+            if (frame.response) {
+              turn.resolve(frame);
+            } else {
+              turn.reject(new Error('已取消'));
+            }
+          }
+          break;
+        case 'error':
+          if (turn) {
+            this.turns.delete(frame.request_id);
+            turn.reject(new Error(frame.detail));
+          }
+          break;
+        case 'session':
+          if (this.onSessionChange) this.onSessionChange(frame);
+          break;
+        default:
+          break;
+      }
+    };
+
+    ws.onclose = () => {
+      this.ready = false;
+      // 连接断开时进行中的聊天无法继续
+      this.turns.forEach(turn => turn.reject(new Error('连接已断开')));
+      this.turns.clear();
+      if (!this.closed) {
+        setTimeout(() => this.connect(), this.retryDelay);
+        this.retryDelay = Math.min(this.retryDelay * 2, 30000);
+      }
+    };
+  }
+
+  isReady() {
+    return this.ready && this.ws.readyState === WebSocket.OPEN;
+  }
+
+  // 发送一轮聊天，onToken接收增量文本，返回的Promise在生成结束时完成
+  chat(sessionId, message, fileUrls, onToken) {
+    const requestId = String(this.nextRequestId++);
+    const promise = new Promise((resolve, reject) => {
+      this.turns.set(requestId, { resolve, reject, onToken });
+    });
+    const frame = { type: 'chat', request_id: requestId, session_id: sessionId, message };
+    if (fileUrls && fileUrls.length > 0) {
+      frame.file_urls = fileUrls;
+    }
+    this.ws.send(JSON.stringify(frame));
+    return { requestId, promise };
+  }
+
+  cancel(requestId) {
+    if (this.isReady()) {
+      this.ws.send(JSON.stringify({ type: 'cancel', request_id: requestId }));
+    }
+  }
+
+  close() {
+    this.closed = true;
+    this.ws.close();
+  }
+}